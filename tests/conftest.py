@@ -1,14 +1,74 @@
 import random as rand
+import wave
 
 import numpy
 import pytest
+import torch
+
+from whisper.audio import SAMPLE_RATE
+from whisper.model import ModelDimensions, Whisper
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="run the benchmarks")
 
 
 def pytest_configure(config):
     config.addinivalue_line("markers", "requires_cuda")
+    config.addinivalue_line("markers", "benchmark: skipped unless --benchmark is given")
+
+
+def pytest_collection_modifyitems(config, items):
+    if not config.getoption("--benchmark"):
+        skip = pytest.mark.skip(reason="run with --benchmark")
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip)
 
 
 @pytest.fixture
 def random():
     rand.seed(42)
     numpy.random.seed(42)
+
+
+@pytest.fixture
+def noise():
+    """Returns a function that makes `seconds` of quiet Gaussian noise, from a seeded generator"""
+    rng = numpy.random.default_rng(0)
+
+    def noise(seconds: float) -> numpy.ndarray:
+        return 1e-3 * rng.standard_normal(int(seconds * SAMPLE_RATE), numpy.float32)
+
+    return noise
+
+
+@pytest.fixture
+def write_wav():
+    """Returns a function that writes int16 samples, shaped (samples,) or (channels, samples),
+    to a 16 kHz WAV file and returns its path"""
+
+    def write_wav(path, pcm: numpy.ndarray) -> str:
+        pcm = numpy.atleast_2d(pcm)
+        with wave.open(str(path), "wb") as f:
+            f.setnchannels(len(pcm))
+            f.setsampwidth(2)
+            f.setframerate(SAMPLE_RATE)
+            f.writeframes(pcm.T.astype("<i2").tobytes())
+        return str(path)
+
+    return write_wav
+
+
+@pytest.fixture(scope="session")
+def random_model():
+    """Returns a function that makes a model with the given dimensions and seeded random weights"""
+
+    def random_model(dims: ModelDimensions, std: float = 0.1) -> Whisper:
+        torch.manual_seed(0)
+        model = Whisper(dims).eval()
+        for parameter in model.parameters():
+            torch.nn.init.normal_(parameter, std=std)
+        return model
+
+    return random_model
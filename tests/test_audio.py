@@ -1,8 +1,24 @@
 import os.path
 
 import numpy as np
+import pytest
+import torch
 
-from whisper.audio import SAMPLE_RATE, load_audio, log_mel_spectrogram
+from whisper.audio import (
+    HOP_LENGTH,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    AudioRingBuffer,
+    MelFrames,
+    _batched_log_mel_spectrogram,
+    _memmap_wav,
+    _normalize,
+    load_audio,
+    log_mel_spectrogram,
+    log_mel_spectrogram_batch,
+    stream_audio,
+)
+from whisper.cache import FeatureCache
 
 
 def test_audio():
@@ -17,3 +33,168 @@ def test_audio():
 
     assert np.allclose(mel_from_audio, mel_from_file)
     assert mel_from_audio.max() - mel_from_audio.min() <= 2.0
+
+
+def test_wav_fast_path(tmp_path, write_wav):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+    wav_path = write_wav(tmp_path / "jfk.wav", (audio * 32768).astype(np.int16))
+
+    assert _memmap_wav(wav_path, SAMPLE_RATE) is not None
+    assert _memmap_wav(wav_path, 8000) is None
+    assert _memmap_wav(audio_path, SAMPLE_RATE) is None
+
+    assert np.array_equal(load_audio(wav_path), audio)
+    assert np.array_equal(np.concatenate(list(stream_audio(wav_path, 3))), audio)
+    assert len(load_audio(wav_path, sr=8000)) == pytest.approx(len(audio) / 2, abs=1)
+
+
+def test_load_audio_channels(tmp_path, write_wav):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+    pcm = (audio * 32768).astype(np.int16)
+    pcm = np.stack([pcm, pcm // 2, np.zeros_like(pcm)])
+    channels = pcm / np.float32(32768)
+    wav_path = write_wav(tmp_path / "channels.wav", pcm)
+
+    assert channels.dtype == np.float32
+    assert _memmap_wav(wav_path, SAMPLE_RATE) is None
+    assert _memmap_wav(wav_path, SAMPLE_RATE, mono=False).shape == (len(audio), 3)
+
+    # decoded in-process, and by ffmpeg when resampling
+    assert np.array_equal(load_audio(wav_path, mono=False), channels)
+    resampled = load_audio(wav_path, sr=8000, mono=False)
+    assert resampled.shape[0] == 3 and resampled.flags.c_contiguous
+    assert np.all(resampled[2] == 0)
+
+    stereo = load_audio(audio_path, mono=False)
+    assert stereo.shape == (2, len(audio))
+    assert np.allclose(stereo.mean(axis=0), audio, atol=1e-4)
+
+
+def test_stream_audio():
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+
+    chunks = list(stream_audio(audio_path, chunk_seconds=3))
+    assert all(chunk.dtype == np.float32 for chunk in chunks)
+    assert all(len(chunk) == 3 * SAMPLE_RATE for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 3 * SAMPLE_RATE
+    assert np.array_equal(np.concatenate(chunks), audio)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 3000])
+@pytest.mark.parametrize("padding", [0, 1234, N_SAMPLES])
+def test_chunked_log_mel_spectrogram(chunk_size, padding):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+    mel = log_mel_spectrogram(audio, padding=padding)
+
+    assert torch.equal(
+        mel, log_mel_spectrogram(audio, padding=padding, chunk_size=chunk_size)
+    )
+    assert torch.equal(
+        mel, log_mel_spectrogram(audio_path, padding=padding, chunk_size=chunk_size)
+    )
+
+    for length in [201, 400, 561]:
+        audio = torch.randn(length)
+        assert torch.equal(
+            log_mel_spectrogram(audio),
+            log_mel_spectrogram(audio, chunk_size=chunk_size),
+        )
+
+
+def test_running_normalization():
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+
+    mel = log_mel_spectrogram(audio)
+    running = log_mel_spectrogram(audio, normalization="running")
+    assert running.shape == mel.shape
+    assert torch.equal(
+        running, log_mel_spectrogram(audio, chunk_size=100, normalization="running")
+    )
+
+    # identical from the loudest frame on, and never clamped above the global floor
+    loudest = mel.amax(dim=0).argmax()
+    assert torch.equal(running[:, loudest:], mel[:, loudest:])
+    assert torch.all(running <= mel)
+
+
+@pytest.mark.parametrize("normalization", ["global", "running"])
+def test_log_mel_spectrogram_batch(normalization):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = torch.from_numpy(load_audio(audio_path))
+    clips = [audio[:n] for n in (16000, 48213, 401, len(audio), 12345)]
+
+    mel, n_frames = log_mel_spectrogram_batch(clips, normalization=normalization)
+    assert mel.shape == (len(clips), 80, len(audio) // HOP_LENGTH)
+    batched = _batched_log_mel_spectrogram(clips, 80, normalization)
+    for i, clip in enumerate(clips):
+        expected = log_mel_spectrogram(clip, normalization=normalization)
+        assert n_frames[i] == expected.shape[-1]
+        assert torch.equal(mel[i, :, : n_frames[i]], expected)
+        assert torch.equal(batched[i, :, : n_frames[i]], expected)
+        assert torch.all(mel[i, :, n_frames[i] :] == 0)
+        assert torch.all(batched[i, :, n_frames[i] :] == 0)
+
+
+def test_feature_cache(tmp_path):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = load_audio(audio_path)
+    mel = log_mel_spectrogram(audio_path, padding=N_SAMPLES)
+
+    cache = FeatureCache(str(tmp_path))
+    for _ in range(2):  # store, then read back
+        assert np.array_equal(load_audio(audio_path, cache_dir=cache), audio)
+        mel_cached = log_mel_spectrogram(audio_path, padding=N_SAMPLES, cache_dir=cache)
+        assert torch.equal(mel_cached, mel)
+    assert len(list(tmp_path.glob("*.npy"))) == 2
+
+    # keys depend on the parameters
+    mel_128 = log_mel_spectrogram(audio_path, n_mels=128, cache_dir=str(tmp_path))
+    assert mel_128.shape[0] == 128
+    assert len(list(tmp_path.glob("*.npy"))) == 3
+
+    # the least recently used entries are evicted first
+    cache.max_size = mel_128.numel() * 4 + 1024
+    cache.evict()
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+    params = dict(sr=SAMPLE_RATE, n_mels=128, padding=0, normalization="global")
+    assert cache.get(cache.key(audio_path, "mel", **params)) is not None
+
+
+def test_audio_ring_buffer():
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = torch.from_numpy(load_audio(audio_path))
+    mel_frames = MelFrames()
+    log_spec = mel_frames.push(audio)
+
+    capacity = 3 * SAMPLE_RATE
+    buffer = AudioRingBuffer(capacity)
+    assert buffer.window().shape == (0,)
+    assert buffer.log_mel_spectrogram().shape == (80, 0)
+
+    pcm = (audio * 32768).to(torch.int16)
+    rng = np.random.default_rng(0)
+    position = 0
+    while position < len(audio):
+        n = int(rng.integers(1, 2 * capacity))
+        piece = pcm[position : position + n]
+        if rng.random() < 0.5:
+            buffer.push(piece.numpy().tobytes())
+        else:
+            buffer.push(piece.float() / 32768.0)
+        position += len(piece)
+
+        n_samples = min(position, capacity)
+        assert torch.equal(buffer.window(), audio[position - n_samples : position])
+
+    assert torch.equal(buffer.window(100), audio[-100:])
+    assert buffer.n_frames == log_spec.shape[-1]
+    for normalization in ["global", "running"]:
+        expected = log_spec[:, -(capacity // HOP_LENGTH) :].clone()
+        expected = _normalize(expected, normalization)
+        mel = buffer.log_mel_spectrogram(normalization=normalization)
+        assert torch.equal(mel, expected)
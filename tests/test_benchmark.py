@@ -0,0 +1,245 @@
+"""
+Benchmarks of the inference speed and memory, run with `pytest tests/test_benchmark.py
+--benchmark -s`; the models have the dimensions of the official ones but random weights, so that
+no checkpoint is needed, and the decoders run for a fixed number of steps instead of up to EOT.
+The accuracy benchmarks transcribe jfk.flac with the official checkpoints instead.
+"""
+
+import copy
+import hashlib
+import io
+import os
+import time
+import tracemalloc
+
+import pytest
+import torch
+
+import whisper
+from whisper import _download
+from whisper.cache import _file_sha256
+from whisper.model import (
+    KVCache,
+    ModelDimensions,
+    Whisper,
+    cache_weight_casts,
+    quantize_int8,
+)
+from whisper.normalizers import EnglishTextNormalizer
+
+pytestmark = pytest.mark.benchmark
+
+DIMS = {
+    "tiny": ModelDimensions(80, 1500, 384, 6, 4, 51865, 448, 384, 6, 4),
+    "base": ModelDimensions(80, 1500, 512, 8, 6, 51865, 448, 512, 8, 6),
+}
+
+
+def best_time(fn, repeat: int = 2) -> float:
+    """The fastest of `repeat` runs of fn, in seconds, after a warmup run"""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def greedy_steps(model: Whisper, audio_features, tokens, kv_cache, n_steps: int):
+    """Run the first pass over `tokens` and then n_steps single-token steps"""
+    with torch.no_grad():
+        logits = model.decoder(tokens, audio_features, kv_cache)
+        for _ in range(n_steps):
+            tokens = logits[:, -1:].argmax(dim=-1)
+            logits = model.decoder(tokens, audio_features, kv_cache)
+
+
+@pytest.mark.parametrize("name", ["tiny", "base"])
+def test_kv_cache_tokens_per_second(name: str, random_model):
+    model = random_model(DIMS[name], std=0.02)
+    n_batch, n_steps = 5, 221  # 224 tokens for each of 5 beams
+    audio_features = torch.randn(1, 1500, model.dims.n_audio_state).repeat(
+        n_batch, 1, 1
+    )
+    tokens = torch.tensor([[50258, 50259, 50359]]).repeat(n_batch, 1)
+
+    def hooks():
+        cache, hooks = model.install_kv_cache_hooks()
+        greedy_steps(model, audio_features, tokens, cache, n_steps)
+        for hook in hooks:
+            hook.remove()
+
+    def static():
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        greedy_steps(model, audio_features, tokens, kv_cache, n_steps)
+
+    n_tokens = n_batch * (n_steps + tokens.shape[1])
+    hooks_speed, static_speed = (n_tokens / best_time(fn) for fn in (hooks, static))
+    print(
+        f"\n{name}: {hooks_speed:.0f} tokens/s with the hooks, "
+        f"{static_speed:.0f} tokens/s with KVCache"
+    )
+
+
+def allocated_bytes(fn) -> int:
+    """The total size of the CPU memory allocations made while running fn"""
+    with torch.profiler.profile(profile_memory=True) as profile:
+        fn()
+    return sum(max(e.cpu_memory_usage, 0) for e in profile.events())
+
+
+@pytest.mark.parametrize("name", ["tiny", "base"])
+def test_weight_cast_cache(name: str, random_model):
+    model = random_model(DIMS[name], std=0.02)  # kept in fp32, run in bf16
+    audio_features = torch.randn(1, 1500, model.dims.n_audio_state).bfloat16()
+    tokens = torch.tensor([[50258, 50259, 50359]])
+
+    def decode():
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        greedy_steps(model, audio_features, tokens, kv_cache, 100)
+
+    def cached():
+        with cache_weight_casts(model.decoder):
+            decode()
+
+    print(f"\n{name}, 100 steps in bf16 with fp32 weights:")
+    for label, fn in [("casting at every step", decode), ("casting once", cached)]:
+        latency = best_time(fn)
+        allocated = allocated_bytes(fn)
+        print(f"{label}: {latency:.2f} s, {allocated / 2**20:.0f} MiB allocated")
+
+
+def serialized_size(model: Whisper) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+@pytest.mark.parametrize("name", ["tiny", "base"])
+def test_int8_latency(name: str, random_model):
+    model = random_model(DIMS[name], std=0.02)
+    quantized = quantize_int8(copy.deepcopy(model))
+    mel = torch.randn(1, model.dims.n_mels, 3000)
+    tokens = torch.tensor([[50258, 50259, 50359]])
+
+    print(f"\n{name}, encoding 30 seconds and 100 decoder steps:")
+    for label, m in [("fp32", model), ("int8", quantized)]:
+        with torch.no_grad():
+            encode = best_time(lambda: m.encoder(mel))
+            audio_features = m.encoder(mel)
+        decode = best_time(
+            lambda: greedy_steps(
+                m, audio_features, tokens, KVCache(m.dims.n_text_ctx), 100
+            )
+        )
+        size = serialized_size(m) / 2**20
+        print(
+            f"{label}: encoder {encode:.2f} s, decoder {decode:.2f} s, {size:.0f} MiB"
+        )
+
+
+JFK = (
+    "And so my fellow Americans, ask not what your country can do for you, "
+    "ask what you can do for your country."
+)
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    normalizer = EnglishTextNormalizer()
+    reference, hypothesis = (
+        normalizer(reference).split(),
+        normalizer(hypothesis).split(),
+    )
+    distances = list(range(len(hypothesis) + 1))
+    for i, word in enumerate(reference, 1):
+        previous, distances[0] = distances[0], i
+        for j, other in enumerate(hypothesis, 1):
+            substitution = previous + (word != other)
+            previous = distances[j]
+            distances[j] = min(distances[j] + 1, distances[j - 1] + 1, substitution)
+    return distances[-1] / len(reference)
+
+
+@pytest.mark.parametrize("name", ["tiny.en", "base.en"])
+def test_int8_accuracy(name: str):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    print(f"\n{name}, transcribing jfk.flac:")
+    for quantize in [None, "int8"]:
+        model = whisper.load_model(name, device="cpu", quantize=quantize)
+        transcribe = lambda: model.transcribe(audio_path, temperature=0.0)  # noqa: E731
+        latency = best_time(transcribe, repeat=1)
+        wer = word_error_rate(JFK, transcribe()["text"])
+        print(f"{quantize or 'fp32'}: {latency:.2f} s, WER {wer:.1%}")
+
+
+@pytest.mark.parametrize("name", ["tiny.en", "base.en"])
+def test_mel_normalization(name: str):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    model = whisper.load_model(name, device="cpu")
+    print(f"\n{name}, transcribing jfk.flac:")
+    for normalization in ["global", "running"]:
+        transcribe = lambda: model.transcribe(  # noqa: E731
+            audio_path, temperature=0.0, mel_normalization=normalization
+        )
+        latency = best_time(transcribe, repeat=1)
+        wer = word_error_rate(JFK, transcribe()["text"])
+        print(f"{normalization} normalization: {latency:.2f} s, WER {wer:.1%}")
+
+
+@pytest.mark.parametrize("name", ["tiny", "base"])
+def test_compiled_decoding(name: str, random_model):
+    model = random_model(DIMS[name], std=0.02)
+    mel = torch.randn(1, model.dims.n_mels, 3000)
+    # suppress EOT, so that every run decodes sample_len tokens
+    options = whisper.DecodingOptions(
+        language="en", sample_len=100, suppress_tokens=[50257], dtype="fp32"
+    )
+
+    eager = best_time(lambda: whisper.decode(model, mel, options))
+    start = time.perf_counter()
+    whisper.decode(model, mel, options, compile=True)
+    first = time.perf_counter() - start
+    compiled = best_time(lambda: whisper.decode(model, mel, options, compile=True))
+    print(
+        f"\n{name}, 100 tokens: {eager:.2f} s eager, {compiled:.2f} s compiled, "
+        f"{first:.1f} s for the first compiled run"
+    )
+
+
+def test_download_startup(tmp_path):
+    # a file the size of the medium checkpoint, already in the cache directory
+    root = tmp_path / "cache"
+    root.mkdir()
+    sha256 = hashlib.sha256()
+    with open(root / "model.pt", "wb") as f:
+        for _ in range(1500):
+            chunk = os.urandom(1 << 20)
+            sha256.update(chunk)
+            f.write(chunk)
+    url = f"https://example.com/{sha256.hexdigest()}/model.pt"
+
+    def read_whole():  # as _download used to
+        with open(root / "model.pt", "rb") as f:
+            assert hashlib.sha256(f.read()).hexdigest() == sha256.hexdigest()
+
+    def load_verified():
+        _download(url, str(root), in_memory=False)
+
+    def load_unverified():
+        os.remove(root / "model.pt.sha256")
+        _file_sha256.cache_clear()  # as in a new process
+        load_verified()
+
+    load_verified()  # write the sidecar
+    print("\nverifying a 1.5 GiB model file:")
+    for label, fn in [
+        ("reading it whole", read_whole),
+        ("hashing it in chunks", load_unverified),
+        ("with a verified sidecar", load_verified),
+    ]:
+        tracemalloc.start()
+        latency = best_time(fn, repeat=1)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        print(f"{label}: {latency:.3f} s, {peak:.0f} MiB peak")
@@ -0,0 +1,37 @@
+import hashlib
+import os
+
+import pytest
+
+import whisper
+from whisper import _download
+
+
+def test_download_sidecar(tmp_path, monkeypatch):
+    content = os.urandom(3 << 20)
+    sha256 = hashlib.sha256(content).hexdigest()
+    source = tmp_path / "source" / sha256 / "model.pt"
+    source.parent.mkdir(parents=True)
+    source.write_bytes(content)
+    url = source.as_uri()
+    root = str(tmp_path / "cache")
+
+    target = _download(url, root, in_memory=False)
+    assert open(target, "rb").read() == content
+    assert os.path.isfile(target + ".sha256")
+
+    # the verified file is not hashed again on later loads
+    def fail(path, *args, **kwargs):
+        raise AssertionError(f"{path} should not be hashed again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(whisper, "file_sha256", fail)
+        assert _download(url, root, in_memory=True) == content
+        assert _download(url, root, in_memory=False) == target
+
+    # a modified file is hashed again, and downloaded again since it does not match
+    with open(target, "r+b") as f:
+        f.write(b"\0" * 16)
+    os.utime(target, ns=(0, 0))
+    with pytest.warns(UserWarning, match="does not match"):
+        assert _download(url, root, in_memory=True) == content
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+LAZY_MODULES = ["numba", "tiktoken", "tqdm", "triton"]
+
+
+def test_import_time():
+    # only the modules imported by whisper itself, as some versions of torch import tqdm
+    code = (
+        "import sys, time; import torch; loaded = set(sys.modules); "
+        "start = time.perf_counter(); import whisper; "
+        "print(time.perf_counter() - start); "
+        f"print(*[m for m in {LAZY_MODULES!r} if m in set(sys.modules) - loaded])"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    elapsed, *loaded = result.stdout.splitlines()
+
+    print(f"import whisper took {float(elapsed):.3f}s after torch")
+    assert not "".join(loaded), f"imported eagerly: {loaded}"
@@ -0,0 +1,373 @@
+import copy
+from contextlib import nullcontext
+from dataclasses import asdict
+
+import pytest
+import torch
+from torch._dynamo.utils import counters
+
+import whisper
+from whisper.model import (
+    KVCache,
+    ModelDimensions,
+    cache_weight_casts,
+    disable_sdpa,
+    quantize_int8,
+)
+
+DIMS = ModelDimensions(
+    n_mels=80,
+    n_audio_ctx=1500,
+    n_audio_state=64,
+    n_audio_head=4,
+    n_audio_layer=2,
+    n_vocab=51865,
+    n_text_ctx=448,
+    n_text_state=64,
+    n_text_head=4,
+    n_text_layer=2,
+)
+
+
+@pytest.fixture(scope="module")
+def model(random_model):
+    return random_model(DIMS)
+
+
+@pytest.mark.parametrize("use_sdpa", [True, False])
+def test_kv_cache(model, use_sdpa: bool):
+    audio_features = torch.randn(1, 1500, 64).repeat(3, 1, 1)  # as in beam search
+    tokens = torch.randint(0, 50000, (3, 12))
+
+    with torch.no_grad(), nullcontext() if use_sdpa else disable_sdpa():
+        expected = model.decoder(tokens, audio_features)
+
+        steps = [(0, 5), (5, 6), (6, 7), (7, 8)]
+        hooked_cache, hooks = model.install_kv_cache_hooks()
+        hooked = [
+            model.decoder(tokens[:, a:b], audio_features, hooked_cache)
+            for a, b in steps
+        ]
+        for hook in hooks:
+            hook.remove()
+
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        for (start, end), hooked_logits in zip(steps, hooked):
+            logits = model.decoder(tokens[:, start:end], audio_features, kv_cache)
+            assert kv_cache.offset == end
+            assert torch.allclose(logits, expected[:, start:end], atol=1e-4)
+            assert torch.allclose(logits, hooked_logits, atol=1e-5)
+
+        # reorder the sequences, as in beam search, and continue decoding
+        source_indices = [2, 2, 0]
+        kv_cache.rearrange(source_indices)
+        tokens = tokens[source_indices]
+        expected = model.decoder(tokens[:, :9], audio_features)
+        logits = model.decoder(tokens[:, 8:9], audio_features, kv_cache)
+        assert torch.allclose(logits, expected[:, 8:9], atol=1e-4)
+
+    kv_cache.reset()
+    assert kv_cache.offset == 0 and not kv_cache.self_attention
+
+
+@pytest.mark.parametrize("use_sdpa", [True, False])
+def test_shared_cross_attention(model, use_sdpa: bool):
+    audio_features = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (6, 8))  # a group of 3 sequences per audio
+
+    with torch.no_grad(), nullcontext() if use_sdpa else disable_sdpa():
+        expected = model.decoder(tokens, audio_features.repeat_interleave(3, dim=0))
+
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        logits = model.decoder(tokens[:, :7], audio_features, kv_cache)
+        assert torch.allclose(logits, expected[:, :7], atol=1e-4)
+
+        cross_attention = dict(kv_cache.cross_attention)
+        assert all(k.shape[0] == 2 for k, _ in cross_attention.values())
+
+        # rearranging the beams within each audio leaves the cross-attention cache as-is
+        source_indices = [1, 1, 0, 5, 3, 4]
+        kv_cache.rearrange(source_indices)
+        assert all(
+            kv_cache.cross_attention[module] is cached
+            for module, cached in cross_attention.items()
+        )
+
+        tokens = tokens[source_indices]
+        expected = model.decoder(tokens, audio_features.repeat_interleave(3, dim=0))
+        logits = model.decoder(tokens[:, 7:], audio_features, kv_cache)
+        assert torch.allclose(logits, expected[:, 7:], atol=1e-4)
+
+
+def test_logits_at_positions(model):
+    audio_features = torch.randn(2, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 10))
+
+    with torch.no_grad():
+        expected = model.decoder(tokens, audio_features)
+        logits = model.decoder(tokens, audio_features, positions=[3, -1])
+        assert logits.shape == (2, 2, model.dims.n_vocab)
+        assert torch.allclose(logits, expected[:, [3, -1]], atol=1e-5)
+
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        model.decoder(tokens[:, :9], audio_features, kv_cache, positions=[-1])
+        logits = model.decoder(tokens[:, 9:], audio_features, kv_cache, positions=[-1])
+        assert torch.allclose(logits, expected[:, -1:], atol=1e-4)
+
+
+def test_cache_weight_casts(model):
+    audio_features = torch.randn(1, 1500, 64, dtype=torch.float64)
+    tokens = torch.randint(0, 50000, (1, 5))
+    linear = model.decoder.blocks[0].mlp[0]
+
+    with torch.no_grad():
+        expected = model.decoder(tokens, audio_features)
+
+        with cache_weight_casts(model):
+            logits = model.decoder(tokens, audio_features)
+            assert torch.allclose(logits, expected)
+            cached = linear.cast_cache["weight", torch.float64]
+            assert linear.cast("weight", torch.float64) is cached
+
+            # loading new weights invalidates the converted copies
+            state_dict = model.state_dict()
+            model.load_state_dict(state_dict)
+            assert not linear.cast_cache
+
+        assert linear.cast_cache is None
+
+
+@pytest.mark.skipif(
+    not torch.backends.quantized.supported_engines, reason="no quantized engine"
+)
+def test_quantize_int8(random_model):
+    model = random_model(DIMS)  # a new one, as it is modified in place
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 6))
+    with torch.no_grad():
+        expected = model(mel, tokens)
+        quantize_int8(model)
+        logits = model(mel, tokens)
+
+    assert isinstance(model.decoder.output_projection, torch.nn.Module)
+    # the token embedding looks up int8 weights instead of keeping the fp32 table
+    assert model.decoder.token_embedding.weight.dtype == torch.int8
+    assert all(p.shape[0] != DIMS.n_vocab for p in model.parameters())
+    assert logits.shape == expected.shape
+    assert (logits - expected).norm() / expected.norm() < 0.1
+
+
+def test_bfloat16(model):
+    audio_features = torch.randn(1, 1500, 64)
+    tokens = torch.randint(0, 50000, (1, 6))
+
+    with torch.no_grad():
+        expected = model.decoder(tokens, audio_features)
+        kv_cache = KVCache(model.dims.n_text_ctx)
+        logits = model.decoder(tokens, audio_features.bfloat16(), kv_cache)
+
+    assert logits.dtype == torch.float32
+    assert all(k.dtype == torch.bfloat16 for k, _ in kv_cache.self_attention.values())
+    assert (logits - expected).norm() / expected.norm() < 0.05
+
+
+def test_fuse_qkv(random_model):
+    model = random_model(DIMS)  # a new one, as it is modified in place
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 6))
+    with torch.no_grad():
+        expected = model(mel, tokens)
+        model.fuse_qkv()
+        assert model.state_dict().keys() == state_dict.keys()
+        assert torch.allclose(model(mel, tokens), expected, atol=1e-4)
+
+        audio_features = model.encoder(mel)
+        kv_cache = KVCache(DIMS.n_text_ctx)
+        model.decoder(tokens[:, :5], audio_features, kv_cache)
+        logits = model.decoder(tokens[:, 5:], audio_features, kv_cache)
+        assert torch.allclose(logits, expected[:, 5:], atol=1e-4)
+
+        # fp32 weights run in bf16 through the fused projection as well
+        attn = model.decoder.blocks[0].attn
+        with cache_weight_casts(model.decoder):
+            logits = model.decoder(tokens, audio_features.bfloat16())
+            assert ("qkv.weight", torch.bfloat16) in attn.cast_cache
+        assert (logits - expected).norm() / expected.norm() < 0.05
+
+        # loading a checkpoint updates the fused weights as well
+        model.load_state_dict({k: torch.zeros_like(v) for k, v in state_dict.items()})
+        assert not model.decoder.blocks[0].attn.qkv[0].any()
+        model.load_state_dict(state_dict)
+        assert torch.allclose(model(mel, tokens), expected, atol=1e-4)
+
+
+@pytest.mark.parametrize("use_sdpa", [True, False])
+def test_static_kv_cache(model, use_sdpa: bool):
+    audio_features = torch.randn(1, 1500, 64)
+    tokens = torch.randint(0, 50000, (3, 10))
+
+    with torch.no_grad(), nullcontext() if use_sdpa else disable_sdpa():
+        expected = model.decoder(tokens, audio_features)
+
+        kv_cache = KVCache(model.dims.n_text_ctx, static=True)
+        logits = model.decoder(tokens[:, :6], audio_features, kv_cache)
+        assert torch.allclose(logits, expected[:, :6], atol=1e-4)
+        kv_cache.offset = 6  # advanced by the caller for a static cache
+
+        for i in range(6, 10):
+            if i == 8:
+                source_indices = [1, 0, 0]
+                kv_cache.rearrange(source_indices)
+                tokens = tokens[source_indices]
+                expected = model.decoder(tokens, audio_features)
+
+            logits = model.decoder(tokens[:, i : i + 1], audio_features, kv_cache)
+            kv_cache.offset += 1
+            assert kv_cache.position.item() == i + 1
+            k, _ = next(iter(kv_cache.self_attention.values()))
+            assert k.shape[1] == model.dims.n_text_ctx  # the shapes do not grow
+            assert torch.allclose(logits, expected[:, i : i + 1], atol=1e-4)
+
+        kv_cache = KVCache(model.dims.n_text_ctx, static=True)
+        logits = model.decoder(tokens[:, :6], audio_features, kv_cache, [2, -1])
+        assert torch.allclose(logits, expected[:, [2, 5]], atol=1e-4)
+        logits = model.decoder(tokens[:, 6:7], audio_features, kv_cache, [-1])
+        assert torch.allclose(logits, expected[:, 6:7], atol=1e-4)
+
+
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_decode_compiled(model, beam_size):
+    mel = torch.randn(2, 80, 3000)
+    options = whisper.DecodingOptions(
+        language="en",
+        prompt="a prompt before the start of transcript token",
+        beam_size=beam_size,
+        sample_len=16,
+        dtype="fp32",
+    )
+
+    with torch.no_grad():
+        expected = whisper.decode(model, mel, options)
+        unique_graphs = counters["stats"]["unique_graphs"]
+        results = whisper.decode(model, mel, options, compile=True)
+
+    # one graph serves every step
+    assert counters["stats"]["unique_graphs"] - unique_graphs <= 1
+    for result, expected_result in zip(results, expected):
+        assert result.tokens == expected_result.tokens
+        assert result.no_speech_prob == pytest.approx(expected_result.no_speech_prob)
+
+
+def test_decode_compiled_with_draft_model(model):
+    draft_model = copy.deepcopy(model)
+    with torch.no_grad():
+        for parameter in draft_model.decoder.parameters():
+            parameter.add_(0.05 * torch.randn_like(parameter))
+
+    mel = torch.randn(80, 3000)
+    # suppress EOT, so that the draft tokens are verified in passes of several lengths
+    options = whisper.DecodingOptions(
+        language="en", sample_len=24, suppress_tokens=[50257], dtype="fp32"
+    )
+
+    with torch.no_grad():
+        expected = whisper.decode(model, mel, options)
+        unique_graphs = counters["stats"]["unique_graphs"]
+        result = whisper.decode(
+            model, mel, options, draft_model=draft_model, compile=True
+        )
+
+    # the verification passes run eagerly, and one graph per model serves the other steps
+    assert counters["stats"]["unique_graphs"] - unique_graphs <= 2
+    assert result.tokens == expected.tokens
+
+
+def test_draft_model_weight_casts(model):
+    draft_model = copy.deepcopy(model)
+    cast_caches = []
+    draft_model.decoder.register_forward_hook(
+        lambda decoder, *_: cast_caches.append(decoder.ln.cast_cache)
+    )
+
+    options = whisper.DecodingOptions(language="en", sample_len=8, dtype="bf16")
+    with torch.no_grad():
+        whisper.decode(model, torch.randn(80, 3000), options, draft_model=draft_model)
+
+    # the fp32 weights of the draft decoder are converted to bf16 once, not at every step
+    assert cast_caches and all(
+        cache is cast_caches[0] and ("weight", torch.bfloat16) in cache
+        for cache in cast_caches
+    )
+
+
+def test_short_audio(model):
+    mel = torch.randn(2, 80, 300)  # 3 seconds
+    with torch.no_grad():
+        audio_features = model.encoder(mel)
+    assert audio_features.shape == (2, 150, 64)
+
+    with pytest.raises(AssertionError):
+        model.encoder(torch.randn(1, 80, 3002))
+
+    # 1.6 seconds, encoded into as many frames as there are mel bins
+    mel = torch.randn(2, 80, 160)
+    options = whisper.DecodingOptions(sample_len=16, dtype="fp32")
+    with torch.no_grad():
+        audio_features = model.encoder(mel)
+        expected = whisper.decode(model, mel, options)
+        results = whisper.decode(model, audio_features, options, encoded=True)
+        _, expected_probs = whisper.detect_language(model, mel)
+        _, probs = whisper.detect_language(model, audio_features, encoded=True)
+
+    assert audio_features.shape == mel.shape[:2] + (64,)
+    assert [r.tokens for r in results] == [r.tokens for r in expected]
+    for p, expected_p in zip(probs, expected_probs):
+        assert p == pytest.approx(expected_p, abs=1e-5)
+
+
+def test_decoder_with_cached_prefix(model):
+    # several tokens after the cached ones, as when verifying the tokens of a draft model
+    audio_features = torch.randn(1, 1500, 64)
+    tokens = torch.randint(0, 50000, (2, 12))
+
+    with torch.no_grad():
+        expected = model.decoder(tokens, audio_features)
+
+        for static in [False, True]:
+            kv_cache = KVCache(model.dims.n_text_ctx, static=static)
+            model.decoder(tokens[:, :9], audio_features, kv_cache)
+            kv_cache.offset = 9
+
+            # discard two of the cached positions, and decode them again with the rest
+            kv_cache.truncate(7)
+            logits = model.decoder(tokens[:, 7:], audio_features, kv_cache)
+            assert torch.allclose(logits, expected[:, 7:], atol=1e-4)
+
+
+def test_load_model_mmap(model, tmp_path, monkeypatch):
+    checkpoint = {
+        "dims": asdict(model.dims),
+        "model_state_dict": {k: v.half() for k, v in model.state_dict().items()},
+    }
+    checkpoint_path = str(tmp_path / "model.pt")
+    torch.save(checkpoint, checkpoint_path)
+
+    loaded = whisper.load_model(checkpoint_path, device="cpu")
+    mapped = whisper.load_model(checkpoint_path, device="cpu", mmap=True)
+    assert mapped.decoder.token_embedding.weight.dtype == torch.float16
+    assert not any(b.is_meta for b in mapped.buffers())
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.randint(0, 50000, (1, 6))
+    with torch.no_grad():
+        expected = loaded(mel, tokens)
+        logits = mapped(mel, tokens)
+    assert torch.allclose(logits, expected, atol=1e-3)
+
+    # the mmap and assign arguments that this needs were added in torch 2.1
+    monkeypatch.setattr(torch, "__version__", "2.0.1")
+    with pytest.raises(ValueError, match="torch 2.1"):
+        whisper.load_model(checkpoint_path, device="cpu", mmap=True)
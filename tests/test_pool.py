@@ -0,0 +1,84 @@
+import threading
+import time
+from dataclasses import asdict
+
+import pytest
+import torch
+
+from whisper import ModelPool
+from whisper.model import ModelDimensions, Whisper
+from whisper.pool import model_size
+
+
+@pytest.fixture(scope="module")
+def checkpoints(tmp_path_factory):
+    paths = []
+    for n_state in [32, 64]:
+        dims = ModelDimensions(80, 1500, n_state, 4, 1, 51865, 448, n_state, 4, 1)
+        path = str(tmp_path_factory.mktemp("models") / f"model-{n_state}.pt")
+        checkpoint = {
+            "dims": asdict(dims),
+            "model_state_dict": Whisper(dims).state_dict(),
+        }
+        torch.save(checkpoint, path)
+        paths.append(path)
+    return paths
+
+
+def test_model_pool(checkpoints):
+    small, large = checkpoints
+    pool = ModelPool()
+
+    model = pool.get(small, device="cpu")
+    assert pool.get(small, device="cpu") is model
+    assert pool.get(small, device="cpu", dtype="fp16") is not model
+    assert (pool.hits, pool.misses, pool.evictions) == (1, 2, 0)
+    assert (small, "cpu", None) in pool and len(pool) == 2
+
+
+def test_model_pool_eviction(checkpoints):
+    small, large = checkpoints
+    sizes = [model_size(ModelPool().get(path, device="cpu")) for path in checkpoints]
+    pool = ModelPool(memory_budget=sizes[0] + sizes[1] - 1)
+
+    pool.get(small, device="cpu")
+    pool.get(large, device="cpu")  # evicts the least recently used one
+    assert (small, "cpu", None) not in pool and (large, "cpu", None) in pool
+    assert pool.evictions == 1
+
+    pool.preload(small, device="cpu").result()
+    model = pool.get(small, device="cpu")
+    assert pool.get(small, device="cpu") is model
+    assert pool.evictions == 2 and len(pool) == 1
+
+
+def test_model_pool_concurrent_get(checkpoints):
+    small, _ = checkpoints
+    pool = ModelPool()
+    loads = []
+    load = pool._load
+
+    def slow_load(key):
+        loads.append(key)
+        time.sleep(0.5)  # let the other threads ask for the model while it loads
+        return load(key)
+
+    pool._load = slow_load
+    models = []
+    threads = [
+        threading.Thread(target=lambda: models.append(pool.get(small, device="cpu")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1 and len(models) == 4
+    assert all(model is models[0] for model in models)
+    assert pool.get(small, device="cpu") is models[0]
+
+    pool._load = lambda key: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        pool.get(small, device="cpu", dtype="fp16")
+    assert not pool._loading
@@ -1,10 +1,23 @@
 import os
 
+import numpy as np
 import pytest
 import torch
 
 import whisper
-from whisper.tokenizer import get_tokenizer
+from whisper.audio import (
+    FRAMES_PER_SECOND,
+    HOP_LENGTH,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    hann_window,
+    log_mel_spectrogram,
+    mel_filters,
+)
+from whisper.tokenizer import get_encoding, get_tokenizer
+from whisper.transcribe import prefetch_mels
+from whisper.vad import detect_speech
 
 
 @pytest.mark.parametrize("model_name", whisper.available_models())
@@ -40,3 +53,152 @@ def test_transcribe(model_name: str):
                 timing_checked = True
 
     assert timing_checked
+
+
+def test_transcribe_int8():
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    model = whisper.load_model("tiny.en", device="cpu")
+    quantized = whisper.load_model("tiny.en", device="cpu", quantize="int8")
+
+    expected = model.transcribe(audio_path, temperature=0.0, fp16=False)["text"]
+    result = quantized.transcribe(audio_path, temperature=0.0, fp16=False)["text"]
+
+    # allow a few words to differ from the full-precision transcription
+    expected_words, words = expected.lower().split(), result.lower().split()
+    assert "my fellow americans" in result.lower()
+    assert len(set(words) ^ set(expected_words)) <= 0.1 * len(expected_words)
+
+
+def test_transcribe_split_channels(tmp_path, write_wav):
+    model = whisper.load_model("tiny.en", device="cpu")
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    pcm = (whisper.load_audio(audio_path) * 32768).astype(np.int16)
+
+    # the second speaker starts after 25 seconds, so that the channels span 1 and 2 windows
+    silence = np.zeros(25 * SAMPLE_RATE, dtype=np.int16)
+    channels = np.stack(
+        [np.concatenate([pcm, silence]), np.concatenate([silence, pcm])]
+    )
+    wav_path = write_wav(tmp_path / "channels.wav", channels)
+
+    results = model.transcribe(wav_path, split_channels=True, temperature=0.0)
+    assert len(results) == 2
+    assert "my fellow americans" in results[1]["text"].lower()
+
+    for result, channel in zip(results, whisper.load_audio(wav_path, mono=False)):
+        expected = model.transcribe(channel, temperature=0.0)
+        assert result["text"] == expected["text"]
+        assert len(result["segments"]) == len(expected["segments"])
+        for segment, expected_segment in zip(result["segments"], expected["segments"]):
+            assert segment["tokens"] == expected_segment["tokens"]
+            assert segment["start"] == expected_segment["start"]
+            assert segment["end"] == expected_segment["end"]
+
+    # a single channel is not split into its samples
+    mono = whisper.load_audio(audio_path)
+    with pytest.raises(ValueError, match="split_channels"):
+        model.transcribe(mono, split_channels=True)
+    with pytest.raises(ValueError, match="split_channels"):
+        model.transcribe(mono, mel=log_mel_spectrogram(mono), split_channels=True)
+
+
+def test_transcribe_vad(monkeypatch, noise):
+    model = whisper.load_model("tiny", device="cpu")
+    speech = whisper.load_audio(os.path.join(os.path.dirname(__file__), "jfk.flac"))
+
+    audio = np.concatenate([noise(40), speech, noise(20)])
+    mel = log_mel_spectrogram(audio, padding=N_SAMPLES)
+    [(start, end)] = detect_speech(mel[:, :-N_FRAMES])
+
+    encoder_inputs = []
+    forward = model.encoder.forward
+    monkeypatch.setattr(
+        model.encoder, "forward", lambda x: encoder_inputs.append(x) or forward(x)
+    )
+
+    result = model.transcribe(audio, vad=True, temperature=0.0)
+    assert result["language"] == "en"
+    assert "my fellow americans" in result["text"].lower()
+    assert all(start <= s["start"] < s["end"] <= end + 1 for s in result["segments"])
+
+    # the language is detected from the first speech region rather than from the noise
+    start_frame = round(start * FRAMES_PER_SECOND)
+    expected = mel[:, start_frame : start_frame + N_FRAMES]
+    assert torch.allclose(encoder_inputs[0][0], expected, atol=1e-4)
+
+    # without speech, nothing is encoded, not even to detect the language
+    for language in ["en", None]:
+        encoder_inputs.clear()
+        result = model.transcribe(
+            noise(40), vad=True, language=language, temperature=0.0
+        )
+        assert result == dict(text="", segments=[], language=language)
+        assert encoder_inputs == []
+
+
+def test_transcribe_short_audio(monkeypatch):
+    model = whisper.load_model("tiny", device="cpu")
+    audio = whisper.load_audio(os.path.join(os.path.dirname(__file__), "jfk.flac"))
+
+    encoder_inputs = []
+    forward = model.encoder.forward
+    monkeypatch.setattr(
+        model.encoder,
+        "forward",
+        lambda x: encoder_inputs.append(x.shape) or forward(x),
+    )
+
+    result = model.transcribe(audio, short_audio=True, temperature=0.0)
+    assert result["language"] == "en"
+    assert "my fellow americans" in result["text"].lower()
+    assert encoder_inputs == [(1, 80, 1100)] * len(encoder_inputs)
+
+    # 1.6 seconds, whose audio features have as many rows as the mel spectrogram
+    encoder_inputs.clear()
+    model.transcribe(audio[: 160 * HOP_LENGTH], short_audio=True, temperature=0.0)
+    assert encoder_inputs and all(shape[1:] == (80, 160) for shape in encoder_inputs)
+
+
+def test_decode_with_draft_model():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = whisper.load_model("base.en", device=device)
+    draft_model = whisper.load_model("tiny.en", device=device)
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    mel = log_mel_spectrogram(whisper.pad_or_trim(whisper.load_audio(audio_path)))
+    mel = mel.to(device)
+
+    options = whisper.DecodingOptions(language="en", dtype="fp32")
+    expected = whisper.decode(model, mel, options)
+    result = whisper.decode(model, mel, options, draft_model=draft_model)
+
+    assert result.tokens == expected.tokens
+    assert result.no_speech_prob == pytest.approx(expected.no_speech_prob, abs=1e-4)
+
+
+def test_warmup():
+    model = whisper.load_model("tiny.en", device="cpu")
+    caches = [get_encoding, mel_filters, hann_window]
+    for cache in [get_tokenizer, *caches]:
+        cache.cache_clear()
+    whisper.warmup(model, word_timestamps=True)
+    assert [cache.cache_info().currsize for cache in caches] == [1, 1, 1]
+
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    result = model.transcribe(audio_path, temperature=0.0, word_timestamps=True)
+    assert [cache.cache_info().misses for cache in caches] == [1, 1, 1]
+    assert "my fellow americans" in result["text"].lower()
+
+
+def test_prefetch_mels():
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    expected = log_mel_spectrogram(audio_path, padding=N_SAMPLES)
+
+    audio_paths = [audio_path] * 3
+    for prefetch in [0, 2]:
+        prefetched = list(prefetch_mels(audio_paths, 80, prefetch=prefetch))
+        assert [path for path, _ in prefetched] == audio_paths
+        for _, mel in prefetched:
+            if prefetch == 0:
+                assert mel is None
+            else:
+                assert torch.equal(torch.from_numpy(mel.result()), expected)
@@ -0,0 +1,23 @@
+import os.path
+
+import numpy as np
+
+from whisper.audio import SAMPLE_RATE, load_audio, log_mel_spectrogram
+from whisper.vad import detect_speech
+
+
+def test_detect_speech(noise):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    speech = load_audio(audio_path)
+    duration = len(speech) / SAMPLE_RATE
+
+    audio = np.concatenate([noise(20), speech, noise(40), speech, noise(5)])
+    regions = detect_speech(log_mel_spectrogram(audio))
+
+    assert len(regions) == 2
+    for (start, end), onset in zip(regions, [20, 60 + duration]):
+        assert onset - 1 <= start <= onset
+        assert onset + duration - 1 <= end <= onset + duration + 1
+
+    assert detect_speech(log_mel_spectrogram(noise(30))) == []
+    assert detect_speech(log_mel_spectrogram(speech)) == [(0.0, duration)]
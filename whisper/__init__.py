@@ -1,16 +1,26 @@
 import hashlib
 import io
+import json
 import os
 import urllib
 import warnings
 from typing import List, Optional, Union
 
 import torch
-from tqdm import tqdm
 
-from .audio import load_audio, log_mel_spectrogram, pad_or_trim
+from .audio import (
+    SAMPLE_RATE,
+    load_audio,
+    log_mel_spectrogram,
+    log_mel_spectrogram_batch,
+    pad_or_trim,
+)
+from .cache import file_sha256
 from .decoding import DecodingOptions, DecodingResult, decode, detect_language
-from .model import ModelDimensions, Whisper
+from .model import ModelDimensions, Whisper, quantize_int8
+from .pool import ModelPool
+from .timing import dtw, median_filter
+from .tokenizer import get_tokenizer
 from .transcribe import transcribe
 from .version import __version__
 
@@ -51,6 +61,30 @@ _ALIGNMENT_HEADS = {
 }
 
 
+def _file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _is_verified(path: str, expected_sha256: str) -> bool:
+    """Whether the sidecar records that the file, unchanged since, has the expected checksum"""
+    try:
+        with open(path + ".sha256", "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return record == {**_file_signature(path), "sha256": expected_sha256}
+
+
+def _mark_verified(path: str, sha256: str):
+    """Record the checksum of the file next to it, along with its size and modification time"""
+    try:
+        with open(path + ".sha256", "w") as f:
+            json.dump({**_file_signature(path), "sha256": sha256}, f)
+    except OSError:
+        pass  # e.g. a read-only cache directory; the file is hashed again next time
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
@@ -61,15 +95,25 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        with open(download_target, "rb") as f:
-            model_bytes = f.read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        # skip hashing the file again if it has been verified and not modified since
+        verified = _is_verified(download_target, expected_sha256)
+        if not verified and file_sha256(download_target) == expected_sha256:
+            _mark_verified(download_target, expected_sha256)
+            verified = True
+
+        if verified:
+            if in_memory:
+                with open(download_target, "rb") as f:
+                    return f.read()
+            return download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file"
             )
 
+    from tqdm import tqdm
+
+    sha256 = hashlib.sha256()
     with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
         with tqdm(
             total=int(source.info().get("Content-Length")),
@@ -84,15 +128,19 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
                     break
 
                 output.write(buffer)
+                sha256.update(buffer)
                 loop.update(len(buffer))
 
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
+    if sha256.hexdigest() != expected_sha256:
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
+    _mark_verified(download_target, expected_sha256)
 
-    return model_bytes if in_memory else download_target
+    if in_memory:
+        with open(download_target, "rb") as f:
+            return f.read()
+    return download_target
 
 
 def available_models() -> List[str]:
@@ -105,6 +153,9 @@ def load_model(
     device: Optional[Union[str, torch.device]] = None,
     download_root: str = None,
     in_memory: bool = False,
+    quantize: Optional[str] = None,
+    fuse_qkv: bool = False,
+    mmap: bool = False,
 ) -> Whisper:
     """
     Load a Whisper ASR model
@@ -120,6 +171,17 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    quantize: str
+        "int8" to quantize the linear layers dynamically for faster inference on CPU with less
+        memory, at a small cost in accuracy; by default, the weights are kept as they are
+    fuse_qkv: bool
+        whether to fuse the query, key and value projections of self-attention into one GEMM,
+        which speeds up decoding with small batches on CPU; ignored when quantizing
+    mmap: bool
+        whether to memory-map the weights from the checkpoint file instead of reading them, and to
+        use them without copying, so that processes on the same host share the page cache; the
+        weights then keep the dtype of the checkpoint, i.e. fp16 for the official models; this
+        requires torch 2.1 or later
 
     Returns
     -------
@@ -129,6 +191,14 @@ def load_model(
 
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    if quantize not in (None, "int8"):
+        raise ValueError(f"Unsupported quantization: {quantize}")
+    if quantize is not None and torch.device(device).type != "cpu":
+        raise ValueError(f"{quantize} quantization is only supported on CPU")
+    if mmap and in_memory:
+        raise ValueError("mmap and in_memory can't be given together")
+    if mmap and torch.__version__ < "2.1":
+        raise ValueError(f"mmap requires torch 2.1 or later, got {torch.__version__}")
     if download_root is None:
         default = os.path.join(os.path.expanduser("~"), ".cache")
         download_root = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
@@ -144,18 +214,56 @@ def load_model(
             f"Model {name} not found; available models = {available_models()}"
         )
 
-    with (
-        io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
-    ) as fp:
-        kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
-        checkpoint = torch.load(fp, map_location=device, **kwargs)
-    del checkpoint_file
+    if mmap:
+        # the tensors stay backed by the file, on the CPU, until the model is moved to the device
+        checkpoint = torch.load(
+            checkpoint_file, map_location="cpu", mmap=True, weights_only=True
+        )
+        dims = ModelDimensions(**checkpoint["dims"])
+        with torch.device("meta"):
+            model = Whisper(dims)
+        model.load_state_dict(checkpoint["model_state_dict"], assign=True)
+        model._init_buffers()
+    else:
+        with (
+            io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
+        ) as fp:
+            kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
+            checkpoint = torch.load(fp, map_location=device, **kwargs)
+        del checkpoint_file
 
-    dims = ModelDimensions(**checkpoint["dims"])
-    model = Whisper(dims)
-    model.load_state_dict(checkpoint["model_state_dict"])
+        dims = ModelDimensions(**checkpoint["dims"])
+        model = Whisper(dims)
+        model.load_state_dict(checkpoint["model_state_dict"])
 
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
 
-    return model.to(device)
+    model = model.to(device)
+
+    if quantize == "int8":
+        quantize_int8(model)
+    elif fuse_qkv:
+        model.fuse_qkv()
+
+    return model
+
+
+def warmup(model: Whisper, word_timestamps: bool = False):
+    """
+    Prepare a process to serve requests with the given model, so that the first one does not pay
+    for the one-time setup: loading the tokenizer, the mel filterbank and the STFT window, and when
+    `word_timestamps` is True, compiling the DTW and median filter kernels. The numba kernels are
+    cached on disk, in `__pycache__` or `NUMBA_CACHE_DIR`, so only the first process compiles them.
+    """
+    tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages)
+    tokenizer.non_speech_tokens  # cached, used to suppress the blank and symbol tokens
+
+    # load the filterbank and the STFT window where transcribe() computes the spectrogram,
+    # i.e. on the CPU whatever the device of the model
+    log_mel_spectrogram(torch.zeros(SAMPLE_RATE), model.dims.n_mels)
+
+    if word_timestamps:
+        x = torch.rand(8, 16, device=model.device)
+        median_filter(x, 7)
+        dtw(x)
@@ -1,12 +1,16 @@
+import io
 import os
+import struct
+from dataclasses import dataclass
 from functools import lru_cache
-from subprocess import CalledProcessError, run
-from typing import Optional, Union
+from subprocess import PIPE, CalledProcessError, Popen, run
+from typing import BinaryIO, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 
+from .cache import FeatureCache, get_cache
 from .utils import exact_div
 
 # hard-coded audio hyperparameters
@@ -21,8 +25,15 @@ N_SAMPLES_PER_TOKEN = HOP_LENGTH * 2  # the initial convolutions has stride 2
 FRAMES_PER_SECOND = exact_div(SAMPLE_RATE, HOP_LENGTH)  # 10ms per audio frame
 TOKENS_PER_SECOND = exact_div(SAMPLE_RATE, N_SAMPLES_PER_TOKEN)  # 20ms per audio token
 
+NORMALIZATIONS = ("global", "running")  # see `log_mel_spectrogram`
 
-def load_audio(file: str, sr: int = SAMPLE_RATE):
+
+def load_audio(
+    file: str,
+    sr: int = SAMPLE_RATE,
+    cache_dir: Optional[Union[str, FeatureCache]] = None,
+    mono: bool = True,
+):
     """
     Open an audio file and read as mono waveform, resampling as necessary
 
@@ -34,32 +45,207 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     sr: int
         The sample rate to resample the audio if necessary
 
+    cache_dir: Optional[Union[str, FeatureCache]]
+        If given, the decoded waveform is cached in this directory, or in this `FeatureCache`,
+        keyed by the file's content; cached waveforms are memory-mapped instead of decoded.
+
+    mono: bool
+        Whether to down-mix the channels; if False, all channels are decoded at once
+
     Returns
     -------
-    A NumPy array containing the audio waveform, in float32 dtype.
+    A NumPy array containing the audio waveform, in float32 dtype, with the shape (samples,) if
+    `mono` is True, or (channels, samples) otherwise.
     """
+    if cache_dir is not None:
+        cache = get_cache(cache_dir)
+        key = cache.key(file, "audio" if mono else "audio_channels", sr=sr)
+        if (audio := cache.get(key)) is None:
+            audio = load_audio(file, sr, mono=mono)
+            cache.put(key, audio)
+        return audio
+
+    # 16-bit PCM WAV files at the requested sample rate are read in-process
+    pcm = _memmap_wav(file, sr, mono)
+    if pcm is None:
+        # This launches a subprocess to decode audio while down-mixing
+        # and resampling as necessary.  Requires the ffmpeg CLI in PATH.
+        try:
+            cmd = _ffmpeg_command(file, sr, mono)
+            out = run(cmd, capture_output=True, check=True).stdout
+        except CalledProcessError as e:
+            raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
 
-    # This launches a subprocess to decode audio while down-mixing
-    # and resampling as necessary.  Requires the ffmpeg CLI in PATH.
+        if mono:
+            pcm = np.frombuffer(out, np.int16)
+        else:
+            # the channel count is only known from the WAV header that ffmpeg writes
+            stream = io.BytesIO(out)
+            wav = _read_wav_header(stream)
+            if wav is None:
+                raise RuntimeError("Failed to load audio: ffmpeg did not output WAV")
+            data = out[stream.tell() :]
+            data = data[: len(data) - len(data) % (2 * wav.channels)]
+            pcm = np.frombuffer(data, np.int16).reshape(-1, wav.channels)
+
+    if mono:
+        audio = pcm.astype(np.float32)
+    else:
+        audio = pcm.T.astype(np.float32, order="C")  # deinterleave
+    audio /= 32768.0
+    return audio
+
+
+def stream_audio(
+    file: str, chunk_seconds: float = CHUNK_LENGTH, sr: int = SAMPLE_RATE
+) -> Iterator[np.ndarray]:
+    """
+    Open an audio file and read it incrementally as mono waveform chunks, resampling as necessary
+
+    Unlike `load_audio`, the decoded PCM stream is never materialized as a whole; ffmpeg's output
+    is read into a reusable buffer, so the memory usage is bounded by the chunk size.
+
+    Parameters
+    ----------
+    file: str
+        The audio file to open
+
+    chunk_seconds: float
+        The duration of each chunk in seconds; the last chunk may be shorter
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    Returns
+    -------
+    An iterator of NumPy arrays containing consecutive chunks of the waveform, in float32 dtype.
+    """
+    chunk_samples = round(chunk_seconds * sr)
+    if chunk_samples <= 0:
+        raise ValueError(f"chunk_seconds should be positive, got {chunk_seconds}")
+
+    pcm = _memmap_wav(file, sr)
+    if pcm is not None:
+        for start in range(0, len(pcm), chunk_samples):
+            chunk = pcm[start : start + chunk_samples].astype(np.float32)
+            chunk /= 32768.0
+            yield chunk
+        return
+
+    buffer = np.empty(chunk_samples, dtype=np.int16)
+    view = memoryview(buffer).cast("B")
+
+    # only errors are logged, so that a full stderr pipe cannot stall the decoding
+    cmd = _ffmpeg_command(file, sr)
+    cmd[1:1] = ["-loglevel", "error"]
+
+    process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    try:
+        while True:
+            filled = 0
+            while filled < len(view):
+                n = process.stdout.readinto(view[filled:])
+                if not n:
+                    break
+                filled += n
+
+            n_samples = filled // 2
+            if n_samples > 0:
+                chunk = buffer[:n_samples].astype(np.float32)
+                chunk /= 32768.0
+                yield chunk
+            if filled < len(view):
+                break
+
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"Failed to load audio: {stderr.decode()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _ffmpeg_command(file: str, sr: int, mono: bool = True):
     # fmt: off
-    cmd = [
+    return [
         "ffmpeg",
         "-nostdin",
         "-threads", "0",
         "-i", file,
-        "-f", "s16le",
-        "-ac", "1",
+        *(["-f", "s16le", "-ac", "1"] if mono else ["-f", "wav"]),
         "-acodec", "pcm_s16le",
         "-ar", str(sr),
         "-"
     ]
     # fmt: on
+
+
+@dataclass
+class _WavFormat:
+    format_tag: int  # 1 for integer PCM, 3 for IEEE float
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    data_size: int  # in bytes; may be a placeholder if the file was written as a stream
+
+
+def _read_wav_header(f: BinaryIO) -> Optional[_WavFormat]:
+    """
+    Parse the header of a RIFF/WAVE stream, leaving `f` at the beginning of the sample data.
+    Only sequential reads are used, so `f` may be a pipe. Returns None if it is not a WAV stream.
+    """
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        return None
+
+    fmt = None
+    while len(chunk := f.read(8)) == 8:
+        chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"data":
+            return None if fmt is None else _WavFormat(*fmt, data_size=size)
+
+        body = f.read(size + size % 2)  # chunks are word-aligned
+        if chunk_id == b"fmt " and len(body) >= 16:
+            format_tag, channels, sample_rate = struct.unpack("<HHI", body[:8])
+            bits_per_sample = struct.unpack("<H", body[14:16])[0]
+            if format_tag == 0xFFFE and len(body) >= 26:
+                # WAVE_FORMAT_EXTENSIBLE; the subformat GUID begins with the format tag
+                format_tag = struct.unpack("<H", body[24:26])[0]
+            fmt = (format_tag, channels, sample_rate, bits_per_sample)
+
+    return None
+
+
+def _memmap_wav(file: str, sr: int, mono: bool = True) -> Optional[np.ndarray]:
+    """
+    Memory-map the samples of a 16-bit PCM WAV file sampled at `sr`, which is exactly what ffmpeg
+    would decode it into, as a (samples,) array if `mono` or a (samples, channels) array otherwise.
+    Returns None for any other file, including multi-channel ones if `mono`, to be transcoded.
+    """
     try:
-        out = run(cmd, capture_output=True, check=True).stdout
-    except CalledProcessError as e:
-        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+        with open(file, "rb") as f:
+            wav = _read_wav_header(f)
+            offset = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+    except (OSError, TypeError, struct.error):
+        return None
+
+    if wav is None or (wav.format_tag, wav.bits_per_sample) != (1, 16):
+        return None
+    if wav.sample_rate != sr or wav.channels == 0 or (mono and wav.channels != 1):
+        return None
 
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+    # the data size is unreliable for WAV files written as a stream, or truncated ones
+    n_samples = min(wav.data_size, file_size - offset) // (2 * wav.channels)
+    shape = (n_samples,) if mono else (n_samples, wav.channels)
+    if n_samples == 0:
+        return np.zeros(shape, dtype=np.int16)
+    pcm = np.memmap(file, dtype="<i2", mode="r", offset=offset, shape=shape)
+    # a plain ndarray view, so that the arrays computed from the samples aren't memmaps
+    return np.asarray(pcm)
 
 
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
@@ -107,11 +293,22 @@ def mel_filters(device, n_mels: int) -> torch.Tensor:
         return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
 
 
+@lru_cache(maxsize=None)
+def hann_window(device) -> torch.Tensor:
+    """
+    the STFT window, created once per device
+    """
+    return torch.hann_window(N_FFT).to(device)
+
+
 def log_mel_spectrogram(
     audio: Union[str, np.ndarray, torch.Tensor],
     n_mels: int = 80,
     padding: int = 0,
     device: Optional[Union[str, torch.device]] = None,
+    chunk_size: Optional[int] = None,
+    normalization: str = "global",
+    cache_dir: Optional[Union[str, FeatureCache]] = None,
 ):
     """
     Compute the log-Mel spectrogram of
@@ -130,11 +327,56 @@ def log_mel_spectrogram(
     device: Optional[Union[str, torch.device]]
         If given, the audio tensor is moved to this device before STFT
 
+    chunk_size: Optional[int]
+        If given, compute the spectrogram in chunks of this many frames, which bounds the memory
+        used by the STFT intermediates and, when `audio` is a path, by the decoded waveform.
+        The output is identical to the one computed in a single pass.
+
+    normalization: str
+        "global" clamps the spectrogram at 8 (i.e. 80 dB) below its maximum over the whole input,
+        which is what the models are trained with. "running" clamps each frame at 8 below the
+        maximum of the frames up to and including it, so that frames can be normalized as soon as
+        they are computed, e.g. when streaming. The two agree from the loudest frame on; before it,
+        the running floor is lower and keeps quieter components, which only affects content that
+        is more than 80 dB below the global peak and usually does not change the transcription.
+
+    cache_dir: Optional[Union[str, FeatureCache]]
+        If given and `audio` is a path, the spectrogram and the decoded waveform are cached in this
+        directory, or in this `FeatureCache`, keyed by the file's content and the parameters above.
+
     Returns
     -------
     torch.Tensor, shape = (n_mels, n_frames)
         A Tensor that contains the Mel spectrogram
     """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"normalization should be one of {NORMALIZATIONS}")
+
+    if isinstance(audio, str) and cache_dir is not None:
+        cache = get_cache(cache_dir)
+        key = cache.key(
+            audio,
+            "mel",
+            sr=SAMPLE_RATE,
+            n_mels=n_mels,
+            padding=padding,
+            normalization=normalization,
+        )
+        if (log_spec := cache.get(key)) is None:
+            audio = load_audio(audio, cache_dir=cache)
+            log_spec = log_mel_spectrogram(
+                audio, n_mels, padding, device, chunk_size, normalization
+            )
+            cache.put(key, log_spec.cpu().numpy())
+            return log_spec
+        log_spec = torch.from_numpy(log_spec)
+        return log_spec if device is None else log_spec.to(device)
+
+    if chunk_size is not None:
+        return _chunked_log_mel_spectrogram(
+            audio, n_mels, padding, device, chunk_size, normalization
+        )
+
     if not torch.is_tensor(audio):
         if isinstance(audio, str):
             audio = load_audio(audio)
@@ -144,7 +386,7 @@ def log_mel_spectrogram(
         audio = audio.to(device)
     if padding > 0:
         audio = F.pad(audio, (0, padding))
-    window = torch.hann_window(N_FFT).to(audio.device)
+    window = hann_window(audio.device)
     stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
     magnitudes = stft[..., :-1].abs() ** 2
 
@@ -152,6 +394,370 @@ def log_mel_spectrogram(
     mel_spec = filters @ magnitudes
 
     log_spec = torch.clamp(mel_spec, min=1e-10).log10()
-    log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
-    log_spec = (log_spec + 4.0) / 4.0
+    return _normalize(log_spec, normalization)
+
+
+def log_mel_spectrogram_batch(
+    audios: Sequence[Union[str, np.ndarray, torch.Tensor]],
+    n_mels: int = 80,
+    padding: int = 0,
+    device: Optional[Union[str, torch.device]] = None,
+    normalization: str = "global",
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Compute the log-Mel spectrograms of multiple waveforms of varying lengths at once,
+    using a single batched STFT and Mel projection; each spectrogram is normalized separately.
+    On CPU, the spectrograms are computed one by one into the batch, which is faster there.
+
+    Parameters
+    ----------
+    audios: Sequence[Union[str, np.ndarray, torch.Tensor]]
+        The paths to audio or NumPy arrays or Tensors containing 1-D audio waveforms in 16 kHz
+
+    n_mels: int
+        The number of Mel-frequency filters, only 80 and 128 are supported
+
+    padding: int
+        Number of zero samples to pad to the right of each waveform
+
+    device: Optional[Union[str, torch.device]]
+        If given, the audio tensors are moved to this device before STFT
+
+    normalization: str
+        How each spectrogram is normalized, see `log_mel_spectrogram`
+
+    Returns
+    -------
+    mel: torch.Tensor, shape = (batch_size, n_mels, max_n_frames)
+        The Mel spectrograms, each padded with zeros after its last frame
+
+    n_frames: torch.Tensor, shape = (batch_size,)
+        The number of frames of each spectrogram
+    """
+    if normalization not in NORMALIZATIONS:
+        raise ValueError(f"normalization should be one of {NORMALIZATIONS}")
+
+    waveforms: List[torch.Tensor] = []
+    for audio in audios:
+        if not torch.is_tensor(audio):
+            if isinstance(audio, str):
+                audio = load_audio(audio)
+            audio = torch.from_numpy(audio)
+        if device is not None:
+            audio = audio.to(device)
+        if padding > 0:
+            audio = F.pad(audio, (0, padding))
+        waveforms.append(audio)
+
+    n_frames = torch.tensor([len(audio) // HOP_LENGTH for audio in waveforms])
+    if waveforms[0].device.type == "cpu":
+        # on CPU, there is no kernel launch overhead to amortize, and the batched STFT is slower
+        # than computing the spectrograms one by one, which keeps the intermediates in cache
+        log_spec = torch.zeros(len(waveforms), n_mels, int(n_frames.max()))
+        for i, audio in enumerate(waveforms):
+            log_spec[i, :, : n_frames[i]] = log_mel_spectrogram(
+                audio, n_mels, normalization=normalization
+            )
+        return log_spec, n_frames
+
+    return _batched_log_mel_spectrogram(waveforms, n_mels, normalization), n_frames
+
+
+def _batched_log_mel_spectrogram(
+    waveforms: List[torch.Tensor], n_mels: int, normalization: str
+) -> torch.Tensor:
+    # apply the centering padding of the STFT to each waveform before batching them,
+    # so that the frames near the end of a waveform are the same as when computed alone
+    max_length = max(len(audio) for audio in waveforms)
+    batch = torch.stack(
+        [
+            F.pad(
+                _reflect_pad(audio, N_FFT // 2, N_FFT // 2),
+                (0, max_length - len(audio)),
+            )
+            for audio in waveforms
+        ]
+    )
+
+    window = hann_window(batch.device)
+    stft = torch.stft(
+        batch, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True
+    )
+    magnitudes = stft[..., :-1].abs() ** 2
+
+    filters = mel_filters(batch.device, n_mels)
+    mel_spec = filters @ magnitudes
+
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    for i, length in enumerate(len(audio) // HOP_LENGTH for audio in waveforms):
+        _normalize(log_spec[i, :, :length], normalization)
+        log_spec[i, :, length:] = 0
+
     return log_spec
+
+
+def _chunked_log_mel_spectrogram(
+    audio: Union[str, np.ndarray, torch.Tensor],
+    n_mels: int,
+    padding: int,
+    device: Optional[Union[str, torch.device]],
+    chunk_size: int,
+    normalization: str,
+):
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size should be positive, got {chunk_size}")
+
+    chunk_samples = chunk_size * HOP_LENGTH
+    if isinstance(audio, str):
+        chunks = map(torch.from_numpy, stream_audio(audio, chunk_samples / SAMPLE_RATE))
+        n_frames = None  # unknown until the stream ends
+    else:
+        if not torch.is_tensor(audio):
+            audio = torch.from_numpy(audio)
+        if audio.ndim != 1:
+            raise ValueError(
+                "chunked spectrograms are only supported for 1-D waveforms"
+            )
+        chunks = audio.split(chunk_samples)
+        n_frames = (len(audio) + padding) // HOP_LENGTH
+
+    if device is None:
+        device = audio.device if torch.is_tensor(audio) else "cpu"
+    frames = MelFrames(n_mels, device)
+
+    def blocks():
+        for chunk in chunks:
+            yield frames.push(chunk)
+        for start in range(0, padding, chunk_samples):
+            yield frames.push(torch.zeros(min(chunk_samples, padding - start)))
+        yield frames.flush()
+
+    if n_frames is None:
+        # the length of a stream is only known at its end; append the frames to a buffer that
+        # doubles when full, which realloc() grows in place for large arrays on Linux, instead of
+        # keeping the blocks and their concatenation in memory at once
+        buffer = np.empty((chunk_size, n_mels), dtype=np.float32)
+        offset = 0
+        for block in blocks():
+            while offset + block.shape[-1] > len(buffer):
+                buffer.resize((2 * len(buffer), n_mels), refcheck=False)
+            buffer[offset : offset + block.shape[-1]] = block.T.cpu().numpy()
+            offset += block.shape[-1]
+        buffer.resize((offset, n_mels), refcheck=False)
+        # the frames are the rows of the buffer; the transposed view is the spectrogram
+        log_spec = torch.from_numpy(buffer).T.to(device)
+    else:
+        log_spec = frames.filters.new_empty(n_mels, n_frames)
+        offset = 0
+        for block in blocks():
+            log_spec[:, offset : offset + block.shape[-1]] = block
+            offset += block.shape[-1]
+
+    # normalized in place; this is the only full-length tensor that is kept in memory
+    return _normalize(log_spec, normalization)
+
+
+def _normalize(log_spec: torch.Tensor, normalization: str) -> torch.Tensor:
+    if normalization == "running":
+        frame_max = log_spec.amax(dim=-2, keepdim=True)
+        floor = torch.cummax(frame_max, dim=-1).values - 8.0
+    else:
+        # unlike max(), amax() does not copy a non-contiguous spectrogram to reduce it
+        floor = log_spec.amax() - 8.0
+
+    torch.maximum(log_spec, floor, out=log_spec)
+    return log_spec.add_(4.0).div_(4.0)
+
+
+class MelFrames:
+    """
+    Computes the log-Mel frames of a waveform that is provided incrementally, in pieces of any size.
+    The concatenated output of `push()` and `flush()` equals the spectrogram that
+    `log_mel_spectrogram` computes over the whole waveform, before the normalization that depends
+    on its maximum value. Only the samples needed by the STFT frames that are not computed yet are
+    kept in memory.
+    """
+
+    def __init__(
+        self, n_mels: int = 80, device: Optional[Union[str, torch.device]] = None
+    ):
+        self.device = torch.device(device or "cpu")
+        self.window = hann_window(self.device)
+        self.filters = mel_filters(self.device, n_mels)
+        self.n_samples = 0  # number of samples received so far
+        self.n_frames = 0  # number of frames returned so far
+        self.pending = torch.zeros(0, device=self.device)  # samples of the next frames
+
+    def push(self, audio: torch.Tensor) -> torch.Tensor:
+        """
+        Append samples to the waveform and return the log-Mel frames that are complete,
+        as a Tensor of shape (n_mels, n_new_frames).
+        """
+        self.pending = torch.cat([self.pending, audio.to(self.device)])
+        if self.n_samples <= N_FFT // 2 < self.n_samples + len(audio):
+            # the STFT is centered; reflect-pad the beginning once enough samples arrived
+            self.pending = _reflect_pad(self.pending, N_FFT // 2, 0)
+        self.n_samples += len(audio)
+
+        if self.n_samples <= N_FFT // 2:
+            return self.filters.new_zeros(self.filters.shape[0], 0)
+        return self._consume(self.pending, min_frames=2)
+
+    def flush(self) -> torch.Tensor:
+        """
+        Mark the end of the waveform and return the remaining log-Mel frames.
+        """
+        if self.n_samples <= N_FFT // 2:
+            # too short to have been padded so far; F.pad raises an error if it's too short at all
+            padded = _reflect_pad(self.pending, N_FFT // 2, N_FFT // 2)
+        else:
+            padded = _reflect_pad(self.pending, 0, N_FFT // 2)
+
+        # the centered STFT has one more frame than `log_mel_spectrogram` keeps, which is computed
+        # and dropped here unless the whole spectrogram is a single frame (see `_consume()`)
+        n_remaining = self.n_samples // HOP_LENGTH - self.n_frames
+        max_frames = 1 if self.n_samples // HOP_LENGTH == 1 else None
+        log_spec = self._consume(padded, max_frames=max_frames)[:, :n_remaining]
+        self.n_frames = self.n_samples // HOP_LENGTH
+        return log_spec
+
+    def _consume(
+        self,
+        samples: torch.Tensor,
+        min_frames: int = 1,
+        max_frames: Optional[int] = None,
+    ) -> torch.Tensor:
+        # a single-frame product with the filters is a matrix-vector multiplication, which may
+        # round differently than the batched one; push() waits for two frames to stay bit-exact.
+        n_frames = max(0, (len(samples) - N_FFT) // HOP_LENGTH + 1)
+        if max_frames is not None:
+            n_frames = min(n_frames, max_frames)
+        if n_frames < min_frames:
+            self.pending = samples
+            return self.filters.new_zeros(self.filters.shape[0], 0)
+
+        samples, self.pending = (
+            samples[: (n_frames - 1) * HOP_LENGTH + N_FFT],
+            samples[n_frames * HOP_LENGTH :],
+        )
+        stft = torch.stft(
+            samples,
+            N_FFT,
+            HOP_LENGTH,
+            window=self.window,
+            center=False,
+            return_complex=True,
+        )
+        magnitudes = stft.abs() ** 2
+        mel_spec = self.filters @ magnitudes
+
+        self.n_frames += n_frames
+        return torch.clamp(mel_spec, min=1e-10).log10()
+
+
+class AudioRingBuffer:
+    """
+    Keeps the latest samples of a live audio stream, e.g. from a microphone or an RTP source, in a
+    fixed amount of memory, along with the log-Mel frames of those samples, which are computed
+    incrementally with `MelFrames` as the samples are pushed. The frames of the latest window are
+    those of the whole stream, so unlike `log_mel_spectrogram(buffer.window())`, the first frames
+    are not computed with reflect padding, and the last few that need future samples are missing.
+    """
+
+    def __init__(
+        self,
+        capacity: int = N_SAMPLES,
+        n_mels: int = 80,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        if capacity < HOP_LENGTH:
+            raise ValueError(f"capacity should be at least {HOP_LENGTH} samples")
+        self.mel_frames = MelFrames(n_mels, device)
+        self.samples = torch.zeros(capacity, device=self.mel_frames.device)
+        self.frames = torch.zeros(
+            n_mels, capacity // HOP_LENGTH, device=self.mel_frames.device
+        )
+        self.n_samples = 0  # number of samples pushed so far
+        self.n_frames = 0  # number of frames computed so far
+
+    def push(self, pcm: Union[bytes, np.ndarray, torch.Tensor]) -> int:
+        """
+        Append PCM samples to the stream and update the log-Mel frames.
+
+        Parameters
+        ----------
+        pcm: Union[bytes, np.ndarray, torch.Tensor]
+            Mono samples in 16 kHz, either 16-bit integers (raw little-endian bytes are read as
+            such) or floating point numbers in [-1, 1]
+
+        Returns
+        -------
+        The number of new log-Mel frames
+        """
+        if isinstance(pcm, bytes):
+            pcm = np.frombuffer(pcm, "<i2")
+        if not torch.is_tensor(pcm):
+            pcm = torch.from_numpy(np.require(pcm, requirements="W"))
+        if pcm.dtype == torch.int16:
+            audio = pcm.to(torch.float32) / 32768.0
+        elif pcm.is_floating_point():
+            audio = pcm.to(torch.float32)
+        else:
+            raise ValueError(f"pcm should be int16 or floating point, got {pcm.dtype}")
+        audio = audio.flatten().to(self.samples.device)
+
+        _write_ring(self.samples, audio, self.n_samples)
+        self.n_samples += len(audio)
+
+        frames = self.mel_frames.push(audio)
+        _write_ring(self.frames, frames, self.n_frames)
+        self.n_frames += frames.shape[-1]
+        return frames.shape[-1]
+
+    def window(self, n_samples: Optional[int] = None) -> torch.Tensor:
+        """
+        Return a copy of the latest `n_samples` samples, by default as many as the capacity;
+        fewer are returned if fewer were pushed.
+        """
+        return _read_ring(self.samples, self.n_samples, n_samples)
+
+    def log_mel_spectrogram(
+        self, n_frames: Optional[int] = None, normalization: str = "global"
+    ) -> torch.Tensor:
+        """
+        Return the latest `n_frames` log-Mel frames, by default as many as fit in the capacity,
+        normalized like `log_mel_spectrogram` does, as a Tensor of shape (n_mels, n_frames).
+        Use `pad_or_trim(mel, N_FRAMES)` to get the input of the model.
+        """
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"normalization should be one of {NORMALIZATIONS}")
+        log_spec = _read_ring(self.frames, self.n_frames, n_frames)
+        if log_spec.shape[-1] == 0:
+            return log_spec
+        return _normalize(log_spec, normalization)
+
+
+def _write_ring(ring: torch.Tensor, data: torch.Tensor, position: int):
+    """Write `data` along the last dimension of the circular buffer `ring` at `position`"""
+    capacity, n = ring.shape[-1], data.shape[-1]
+    if n > capacity:  # only the last `capacity` elements would remain
+        data, position, n = data[..., -capacity:], position + n - capacity, capacity
+
+    start = position % capacity
+    first = min(n, capacity - start)
+    ring[..., start : start + first] = data[..., :first]
+    ring[..., : n - first] = data[..., first:]
+
+
+def _read_ring(ring: torch.Tensor, position: int, n: Optional[int]) -> torch.Tensor:
+    """Return a copy of the last `n` elements written to `ring` before `position`"""
+    capacity = ring.shape[-1]
+    n = min(capacity if n is None else n, capacity, position)
+    start = (position - n) % capacity
+    if start + n <= capacity:
+        return ring[..., start : start + n].clone()
+    return torch.cat([ring[..., start:], ring[..., : start + n - capacity]], dim=-1)
+
+
+def _reflect_pad(samples: torch.Tensor, left: int, right: int) -> torch.Tensor:
+    return F.pad(samples[None, None], (left, right), mode="reflect")[0, 0]
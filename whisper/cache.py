@@ -0,0 +1,96 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import Optional, Union
+
+import numpy as np
+
+DEFAULT_MAX_SIZE = 16 * 1024**3  # 16 GiB
+
+
+@lru_cache(maxsize=1024)
+def _file_sha256(path: str, size: int, mtime_ns: int) -> str:
+    # the size and the modification time are part of the lru_cache key, so that
+    # a file is hashed only once per process unless it changes in between
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while buffer := f.read(1 << 20):
+            sha256.update(buffer)
+    return sha256.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    """Returns the SHA256 hex digest of the file's content, reading it in chunks"""
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return _file_sha256(path, stat.st_size, stat.st_mtime_ns)
+
+
+class FeatureCache:
+    """
+    An on-disk cache of features computed from audio files, such as the decoded waveform or the
+    log-Mel spectrogram. Each entry is a `.npy` file that is memory-mapped when read, keyed by the
+    SHA256 of the audio file and the parameters used to compute the features. When the total size
+    of the entries exceeds `max_size` bytes, the least recently used ones are deleted.
+    """
+
+    def __init__(self, root: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, file: str, kind: str, **params) -> str:
+        """Returns the cache key of the features `kind` computed from `file` with `params`"""
+        params = "-".join(f"{name}={params[name]}" for name in sorted(params))
+        return f"{file_sha256(file)}-{kind}-{params}"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Returns the cached array as a copy-on-write memory map, or None if it is not cached"""
+        path = os.path.join(self.root, key + ".npy")
+        try:
+            array = np.load(path, mmap_mode="c", allow_pickle=False)
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        # returned as an ndarray rather than the np.memmap subclass, which numpy would
+        # otherwise propagate to every array derived from it
+        return np.asarray(array)
+
+    def put(self, key: str, array: np.ndarray) -> None:
+        """Stores the array under `key`, evicting the least recently used entries as needed"""
+        if array.nbytes > self.max_size:
+            return
+
+        path = os.path.join(self.root, key + ".npy")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(temp_path, path)  # atomic, in case of concurrent readers or writers
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Deletes the least recently used entries until the total size fits in `max_size`"""
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.endswith(".npy") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # already evicted by another process
+            total_size -= size
+
+
+def get_cache(cache_dir: Union[str, FeatureCache]) -> FeatureCache:
+    """Returns the given cache, or one with the default size limit at the given directory"""
+    if isinstance(cache_dir, FeatureCache):
+        return cache_dir
+    return FeatureCache(cache_dir)
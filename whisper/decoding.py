@@ -1,3 +1,4 @@
+import weakref
 from dataclasses import dataclass, field, replace
 from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
@@ -15,14 +16,30 @@ if TYPE_CHECKING:
     from .model import Whisper
 
 
+def _is_encoded(model: "Whisper", x: Tensor, encoded: Optional[bool] = None) -> bool:
+    """
+    Whether x holds encoded audio features rather than a Mel spectrogram. Unless `encoded` says so,
+    only the features of a 30-second window are recognized: those of a shorter window can have the
+    same shape as a spectrogram, e.g. (80, 384) for tiny and 1.6 seconds of audio.
+    """
+    if encoded is not None:
+        return encoded
+    return x.shape[-2:] == (model.dims.n_audio_ctx, model.dims.n_audio_state)
+
+
 @torch.no_grad()
 def detect_language(
-    model: "Whisper", mel: Tensor, tokenizer: Tokenizer = None
+    model: "Whisper",
+    mel: Tensor,
+    tokenizer: Tokenizer = None,
+    encoded: Optional[bool] = None,
 ) -> Tuple[Tensor, List[dict]]:
     """
     Detect the spoken language in the audio, and return them as list of strings, along with the ids
     of the most probable language tokens and the probability distribution over all language tokens.
     This is performed outside the main decode loop in order to not interfere with kv-caching.
+    `encoded` tells whether mel holds encoded audio features, which is needed for those of a
+    window shorter than 30 seconds.
 
     Returns
     -------
@@ -48,7 +65,7 @@ def detect_language(
         mel = mel.unsqueeze(0)
 
     # skip encoder forward pass if already-encoded audio features were given
-    if mel.shape[-2:] != (model.dims.n_audio_ctx, model.dims.n_audio_state):
+    if not _is_encoded(model, mel, encoded):
         mel = model.encoder(mel)
 
     # forward pass using a single token, startoftranscript
@@ -77,6 +94,9 @@ def detect_language(
     return language_tokens, language_probs
 
 
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
 @dataclass(frozen=True)
 class DecodingOptions:
     # whether to perform X->X "transcribe" or X->English "translate"
@@ -111,7 +131,16 @@ class DecodingOptions:
     max_initial_timestamp: Optional[float] = 1.0
 
     # implementation details
-    fp16: bool = True  # use fp16 for most of the calculation
+    dtype: Optional[str] = None  # "fp32", "fp16" or "bf16" for most of the calculation
+    # deprecated; same as dtype="fp16" if True or "fp32" if False, unless dtype is given
+    fp16: bool = True
+    # use a static kv cache and a decoder step compiled with torch.compile
+    compile: bool = False
+
+    # speculative decoding: a smaller model with the same tokenizer, e.g. "tiny" or "base", proposes
+    # draft_length tokens at a time, which the model verifies in one forward pass; greedy only
+    draft_model: Optional["Whisper"] = None
+    draft_length: int = 4
 
 
 @dataclass(frozen=True)
@@ -128,14 +157,26 @@ class DecodingResult:
 
 
 class Inference:
-    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        """Perform a forward pass on the decoder and return per-token logits"""
+    def logits(
+        self,
+        tokens: Tensor,
+        audio_features: Tensor,
+        positions: Optional[List[int]] = None,
+    ) -> Tensor:
+        """
+        Perform a forward pass on the decoder and return per-token logits, only at the given
+        indices of `tokens` if `positions` is given
+        """
         raise NotImplementedError
 
     def rearrange_kv_cache(self, source_indices) -> None:
         """Update the key-value cache according to the updated beams"""
         raise NotImplementedError
 
+    def truncate_kv_cache(self, length: int) -> None:
+        """Discard the key-value cache of the tokens from the given length on"""
+        raise NotImplementedError
+
     def cleanup_caching(self) -> None:
         """Clean up any resources or hooks after decoding is finished"""
         pass
@@ -143,37 +184,87 @@ class Inference:
 
 class PyTorchInference(Inference):
     def __init__(self, model: "Whisper", initial_token_length: int):
+        from .model import KVCache
+
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
-        self.kv_cache = {}
-        self.hooks = []
+        self.kv_cache = KVCache(model.dims.n_text_ctx)
 
-        key_modules = [block.attn.key for block in self.model.decoder.blocks]
-        value_modules = [block.attn.value for block in self.model.decoder.blocks]
-        self.kv_modules = key_modules + value_modules
+    def logits(
+        self,
+        tokens: Tensor,
+        audio_features: Tensor,
+        positions: Optional[List[int]] = None,
+    ) -> Tensor:
+        # only need to use the tokens that are not cached yet, i.e. the last one after the first pass
+        offset = self.kv_cache.offset
+        tokens = tokens[:, offset:]
+        if positions is not None:
+            positions = [p - offset if p >= 0 else p for p in positions]
+
+        return self.model.decoder(
+            tokens, audio_features, kv_cache=self.kv_cache, positions=positions
+        )
 
-    def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
-        if not self.kv_cache:
-            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+    def cleanup_caching(self):
+        self.kv_cache.reset()
 
-        if tokens.shape[-1] > self.initial_token_length:
-            # only need to use the last token except in the first forward pass
-            tokens = tokens[:, -1:]
+    def rearrange_kv_cache(self, source_indices):
+        if source_indices != list(range(len(source_indices))):
+            # update the key/value cache to contain the selected sequences
+            self.kv_cache.rearrange(source_indices)
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+    def truncate_kv_cache(self, length: int):
+        self.kv_cache.truncate(length)
 
-    def cleanup_caching(self):
-        for hook in self.hooks:
-            hook.remove()
 
-        self.kv_cache = {}
-        self.hooks = []
+class CompiledInference(PyTorchInference):
+    """
+    Decodes with a static kv cache, for which every single-token step after the first forward pass
+    over the initial tokens has the same shapes; these steps run a decoder compiled once per model.
+    """
 
-    def rearrange_kv_cache(self, source_indices):
-        if source_indices != list(range(len(source_indices))):
-            for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
+    compiled_decoders = weakref.WeakKeyDictionary()  # maps models to compiled decoders
+
+    def __init__(self, model: "Whisper", initial_token_length: int):
+        from .model import KVCache
+
+        super().__init__(model, initial_token_length)
+        self.kv_cache = KVCache(model.dims.n_text_ctx, static=True)
+
+        if model not in self.compiled_decoders:
+            self.compiled_decoders[model] = torch.compile(model.decoder, dynamic=False)
+        self.compiled_decoder = self.compiled_decoders[model]
+
+    def logits(
+        self,
+        tokens: Tensor,
+        audio_features: Tensor,
+        positions: Optional[List[int]] = None,
+    ) -> Tensor:
+        offset = self.kv_cache.offset
+        tokens = tokens[:, offset:]
+        if offset + tokens.shape[-1] > self.kv_cache.n_ctx:
+            raise ValueError(
+                f"the cache can hold at most {self.kv_cache.n_ctx} positions"
+            )
+        if positions is not None:
+            positions = [p - offset if p >= 0 else p for p in positions]
+
+        # the passes over several tokens, i.e. the first one over the initial tokens and those
+        # verifying the tokens of a draft model, have varying lengths; run them eagerly
+        if offset > 0 and tokens.shape[-1] == 1:
+            # a copy with fixed strides; those of the slice grow with the sequence and would
+            # recompile the decoder at every step
+            tokens = tokens.clone(memory_format=torch.contiguous_format)
+            decoder = self.compiled_decoder
+        else:
+            decoder = self.model.decoder
+        logits = decoder(
+            tokens, audio_features, kv_cache=self.kv_cache, positions=positions
+        )
+        self.kv_cache.offset += tokens.shape[-1]
+        return logits
 
 
 class SequenceRanker:
@@ -523,6 +614,9 @@ class DecodingTask:
         )
         self.tokenizer: Tokenizer = tokenizer
         self.options: DecodingOptions = self._verify_options(options)
+        self.dtype: torch.dtype = DTYPES[
+            options.dtype or ("fp16" if options.fp16 else "fp32")
+        ]
 
         self.n_group: int = options.beam_size or options.best_of or 1
         self.n_ctx: int = model.dims.n_text_ctx
@@ -537,7 +631,13 @@ class DecodingTask:
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
 
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        inference_class = CompiledInference if options.compile else PyTorchInference
+        self.inference = inference_class(model, len(self.initial_tokens))
+        self.draft_inference: Optional[Inference] = None
+        if options.draft_model is not None:
+            self.draft_inference = inference_class(
+                options.draft_model, len(self.initial_tokens)
+            )
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
@@ -581,6 +681,17 @@ class DecodingTask:
             0 <= options.length_penalty <= 1
         ):
             raise ValueError("length_penalty (alpha) should be a value between 0 and 1")
+        if options.dtype is not None and options.dtype not in DTYPES:
+            raise ValueError(f"dtype should be one of {list(DTYPES)}")
+        if options.draft_model is not None:
+            if options.temperature != 0 or options.beam_size is not None:
+                raise ValueError(
+                    "draft_model requires greedy decoding without beam_size"
+                )
+            if options.draft_model.dims.n_vocab != self.model.dims.n_vocab:
+                raise ValueError("draft_model should have the same vocabulary")
+            if options.draft_length < 1:
+                raise ValueError("draft_length should be positive")
 
         return options
 
@@ -641,22 +752,16 @@ class DecodingTask:
 
         return tuple(sorted(set(suppress_tokens)))
 
-    def _get_audio_features(self, mel: Tensor):
-        if self.options.fp16:
-            mel = mel.half()
+    def _get_audio_features(self, mel: Tensor, encoded: Optional[bool] = None):
+        mel = mel.to(self.dtype)
 
-        if mel.shape[-2:] == (
-            self.model.dims.n_audio_ctx,
-            self.model.dims.n_audio_state,
-        ):
+        if _is_encoded(self.model, mel, encoded):
             # encoded audio features are given; skip audio encoding
             audio_features = mel
         else:
             audio_features = self.model.encoder(mel)
 
-        if audio_features.dtype != (
-            torch.float16 if self.options.fp16 else torch.float32
-        ):
+        if audio_features.dtype != self.dtype:
             return TypeError(
                 f"audio_features has an incorrect dtype: {audio_features.dtype}"
             )
@@ -669,7 +774,7 @@ class DecodingTask:
 
         if self.options.language is None or self.options.task == "lang_id":
             lang_tokens, lang_probs = self.model.detect_language(
-                audio_features, self.tokenizer
+                audio_features, self.tokenizer, encoded=True
             )
             languages = [max(probs, key=probs.get) for probs in lang_probs]
             if self.options.language is None:
@@ -677,19 +782,43 @@ class DecodingTask:
 
         return languages, lang_probs
 
-    def _main_loop(self, audio_features: Tensor, tokens: Tensor):
+    def _get_draft_audio_features(
+        self,
+        mel: Tensor,
+        draft_audio_features: Optional[Tensor],
+        encoded: Optional[bool] = None,
+    ) -> Tensor:
+        if draft_audio_features is None:
+            if _is_encoded(self.model, mel, encoded):
+                raise ValueError(
+                    "draft_audio_features should be given along with encoded audio features"
+                )
+            draft_audio_features = self.options.draft_model.encoder(mel.to(self.dtype))
+
+        return draft_audio_features.to(self.dtype)
+
+    def _main_loop(
+        self,
+        audio_features: Tensor,
+        tokens: Tensor,
+        draft_audio_features: Optional[Tensor] = None,
+    ):
+        if self.draft_inference is not None:
+            return self._speculative_loop(audio_features, tokens, draft_audio_features)
+
         n_batch = tokens.shape[0]
         sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
         no_speech_probs = [np.nan] * n_batch
 
         try:
             for i in range(self.sample_len):
-                logits = self.inference.logits(tokens, audio_features)
+                # only compute the logits at the last token, and at the SOT token if needed
+                collect_no_speech = i == 0 and self.tokenizer.no_speech is not None
+                positions = [self.sot_index, -1] if collect_no_speech else [-1]
+                logits = self.inference.logits(tokens, audio_features, positions)
 
-                if (
-                    i == 0 and self.tokenizer.no_speech is not None
-                ):  # save no_speech_probs
-                    probs_at_sot = logits[:, self.sot_index].float().softmax(dim=-1)
+                if collect_no_speech:  # save no_speech_probs
+                    probs_at_sot = logits[:, 0].float().softmax(dim=-1)
                     no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
 
                 # now we need to consider the logits at the last token only
@@ -709,13 +838,95 @@ class DecodingTask:
 
         return tokens, sum_logprobs, no_speech_probs
 
+    def _speculative_loop(
+        self, audio_features: Tensor, tokens: Tensor, draft_audio_features: Tensor
+    ):
+        """
+        The greedy sampling loop, where the draft model proposes the next tokens and the model
+        computes the logits for all of them in one forward pass; the proposals are accepted up to
+        the first one that differs from the model's own choice, which replaces it. The result is
+        the same as `_main_loop()`, up to the floating-point differences between the logits of a
+        multi-token and a single-token forward pass.
+        """
+        n_batch = tokens.shape[0]
+        sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
+        no_speech_probs = [np.nan] * n_batch
+        max_length = min(self.sample_begin + self.sample_len, self.n_ctx + 1)
+
+        def apply_filters(logits: Tensor, tokens: Tensor):
+            for logit_filter in self.logit_filters:
+                logit_filter.apply(logits, tokens)
+
+        try:
+            completed = False
+            collect_no_speech = self.tokenizer.no_speech is not None
+            while not completed and tokens.shape[-1] < max_length:
+                # the draft model proposes the next tokens greedily, without exceeding the context
+                n_draft = min(
+                    self.options.draft_length,
+                    max_length - tokens.shape[-1] - 1,
+                    self.n_ctx - tokens.shape[-1],
+                )
+                draft_tokens = tokens
+                for _ in range(n_draft):
+                    draft_logits = self.draft_inference.logits(
+                        draft_tokens, draft_audio_features, [-1]
+                    )[:, -1]
+                    apply_filters(draft_logits, draft_tokens)
+                    next_tokens = draft_logits.argmax(dim=-1, keepdim=True)
+                    draft_tokens = torch.cat([draft_tokens, next_tokens], dim=-1)
+
+                # the model computes the logits after the last token and after each proposal
+                positions = list(range(tokens.shape[-1] - 1, draft_tokens.shape[-1]))
+                if collect_no_speech:
+                    positions = [self.sot_index] + positions
+                logits = self.inference.logits(draft_tokens, audio_features, positions)
+
+                if collect_no_speech:  # save no_speech_probs
+                    probs_at_sot = logits[:, 0].float().softmax(dim=-1)
+                    no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
+                    logits = logits[:, 1:]
+                    collect_no_speech = False
+
+                for i in range(n_draft + 1):
+                    apply_filters(logits[:, i], tokens)
+                    tokens, completed = self.decoder.update(
+                        tokens, logits[:, i], sum_logprobs
+                    )
+                    if completed or i == n_draft:
+                        break
+                    proposed = draft_tokens[:, tokens.shape[-1] - 1]
+                    if not torch.equal(tokens[:, -1], proposed):
+                        break  # reject the remaining proposals
+
+                # roll back the caches to the accepted tokens, except the last one not yet fed
+                self.inference.truncate_kv_cache(tokens.shape[-1] - 1)
+                self.draft_inference.truncate_kv_cache(tokens.shape[-1] - 1)
+        finally:
+            self.inference.cleanup_caching()
+            self.draft_inference.cleanup_caching()
+
+        return tokens, sum_logprobs, no_speech_probs
+
     @torch.no_grad()
-    def run(self, mel: Tensor) -> List[DecodingResult]:
+    def run(
+        self,
+        mel: Tensor,
+        draft_audio_features: Optional[Tensor] = None,
+        encoded: Optional[bool] = None,
+    ) -> List[DecodingResult]:
+        from .model import cache_weight_casts
+
         self.decoder.reset()
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
 
-        audio_features: Tensor = self._get_audio_features(mel)  # encoder forward pass
+        # encoder forward pass
+        audio_features: Tensor = self._get_audio_features(mel, encoded)
+        if self.draft_inference is not None:
+            draft_audio_features = self._get_draft_audio_features(
+                mel, draft_audio_features, encoded
+            )
         tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
 
         # detect language if requested, overwriting the language token
@@ -733,11 +944,16 @@ class DecodingTask:
         # repeat text tensors by the group size, for beam search or best-of-n sampling
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
-        # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
+        # call the main sampling loop, converting the weights of the decoders, including that of
+        # the draft model, to the dtype of the activations only once rather than at every step
+        models = filter(None, [self.model, self.options.draft_model])
+        with cache_weight_casts(*[model.decoder for model in models]):
+            tokens, sum_logprobs, no_speech_probs = self._main_loop(
+                audio_features, tokens, draft_audio_features
+            )
 
-        # reshape the tensors to have (n_audio, n_group) as the first two dimensions
-        audio_features = audio_features[:: self.n_group]
+        # reshape the tensors to have (n_audio, n_group) as the first two dimensions;
+        # audio_features is not repeated, as the group shares its cross-attention keys and values
         no_speech_probs = no_speech_probs[:: self.n_group]
         assert audio_features.shape[0] == len(no_speech_probs) == n_audio
 
@@ -794,6 +1010,8 @@ def decode(
     model: "Whisper",
     mel: Tensor,
     options: DecodingOptions = DecodingOptions(),
+    draft_audio_features: Optional[Tensor] = None,
+    encoded: Optional[bool] = None,
     **kwargs,
 ) -> Union[DecodingResult, List[DecodingResult]]:
     """
@@ -805,11 +1023,19 @@ def decode(
         the Whisper model instance
 
     mel: torch.Tensor, shape = (80, 3000) or (*, 80, 3000)
-        A tensor containing the Mel spectrogram(s)
+        A tensor containing the Mel spectrogram(s), or the encoded audio features; shorter inputs
+        are encoded and decoded as they are, see `AudioEncoder.forward()`
 
     options: DecodingOptions
         A dataclass that contains all necessary options for decoding 30-second segments
 
+    draft_audio_features: Optional[torch.Tensor]
+        The audio features encoded by `options.draft_model`, if `mel` holds encoded audio features
+
+    encoded: Optional[bool]
+        Whether `mel` holds encoded audio features; by default, only those of 30-second segments
+        are recognized as such, as shorter ones may have the same shape as a Mel spectrogram
+
     Returns
     -------
     result: Union[DecodingResult, List[DecodingResult]]
@@ -817,10 +1043,12 @@ def decode(
     """
     if single := mel.ndim == 2:
         mel = mel.unsqueeze(0)
+        if draft_audio_features is not None:
+            draft_audio_features = draft_audio_features.unsqueeze(0)
 
     if kwargs:
         options = replace(options, **kwargs)
 
-    result = DecodingTask(model, options).run(mel)
+    result = DecodingTask(model, options).run(mel, draft_audio_features, encoded)
 
     return result[0] if single else result
@@ -2,7 +2,7 @@ import base64
 import gzip
 from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -36,26 +36,74 @@ class ModelDimensions:
     n_text_layer: int
 
 
-class LayerNorm(nn.LayerNorm):
+class CastCacheMixin:
+    """
+    Converts the parameters of a module to the dtype of its inputs, and keeps the converted copies
+    for reuse while `cast_cache` is enabled by `cache_weight_casts()`; they are dropped whenever the
+    parameters are replaced, i.e. on `load_state_dict()` or `to()`.
+    """
+
+    cast_cache: Optional[Dict[Tuple[str, torch.dtype], Tensor]] = None
+
+    def cast(
+        self, name: str, dtype: torch.dtype, parameter: Optional[Tensor] = None
+    ) -> Tensor:
+        """Convert the parameter `name`, or the given tensor cached under `name`, to `dtype`"""
+        if parameter is None:
+            parameter = self.get_parameter(name)
+        if self.cast_cache is None:
+            return parameter.to(dtype)
+        if (name, dtype) not in self.cast_cache:
+            self.cast_cache[name, dtype] = parameter.detach().to(dtype)
+        return self.cast_cache[name, dtype]
+
+    def _apply(self, *args, **kwargs):
+        if self.cast_cache:
+            self.cast_cache.clear()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        if self.cast_cache:
+            self.cast_cache.clear()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+
+class LayerNorm(CastCacheMixin, nn.LayerNorm):
     def forward(self, x: Tensor) -> Tensor:
-        return super().forward(x.float()).type(x.dtype)
+        if x.dtype == torch.bfloat16:
+            # bf16 has the range of fp32 and layer_norm accumulates in fp32, so skip the conversion
+            return F.layer_norm(
+                x,
+                self.normalized_shape,
+                self.cast("weight", x.dtype),
+                self.cast("bias", x.dtype),
+                self.eps,
+            )
+        # the weights may be stored in another dtype, e.g. when loaded with mmap
+        return F.layer_norm(
+            x.float(),
+            self.normalized_shape,
+            self.cast("weight", torch.float32),
+            self.cast("bias", torch.float32),
+            self.eps,
+        ).type(x.dtype)
 
 
-class Linear(nn.Linear):
+class Linear(CastCacheMixin, nn.Linear):
     def forward(self, x: Tensor) -> Tensor:
         return F.linear(
             x,
-            self.weight.to(x.dtype),
-            None if self.bias is None else self.bias.to(x.dtype),
+            self.cast("weight", x.dtype),
+            None if self.bias is None else self.cast("bias", x.dtype),
         )
 
 
-class Conv1d(nn.Conv1d):
-    def _conv_forward(
-        self, x: Tensor, weight: Tensor, bias: Optional[Tensor]
-    ) -> Tensor:
-        return super()._conv_forward(
-            x, weight.to(x.dtype), None if bias is None else bias.to(x.dtype)
+class Conv1d(CastCacheMixin, nn.Conv1d):
+    def forward(self, x: Tensor) -> Tensor:
+        return self._conv_forward(
+            x,
+            self.cast("weight", x.dtype),
+            None if self.bias is None else self.cast("bias", x.dtype),
         )
 
 
@@ -68,6 +116,89 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 
+class KVCache:
+    """
+    The key and value tensors of the decoder's attention layers for the previous positions, to be
+    reused when decoding the next tokens. The self-attention keys and values are written in place
+    into buffers preallocated for `n_ctx` positions, at the current `offset`, instead of being
+    concatenated at every step; the cross-attention ones are computed once per audio, shared by
+    all sequences decoding it, and are left untouched by `rearrange()`.
+
+    A `static` cache is instead written at the positions given by a tensor, and the attention
+    covers the whole buffers with a mask, so that the shapes of a decoding step do not depend on
+    the number of positions decoded so far, e.g. for `torch.compile`. `TextDecoder` then advances
+    `position` rather than `offset`, which is left to the caller.
+    """
+
+    def __init__(self, n_ctx: int, static: bool = False):
+        self.n_ctx = n_ctx
+        self.offset = 0  # the number of positions already in the cache
+        self.static = static
+        # for a static cache: the next position, the positions being written, and the
+        # mask over the buffers
+        self.position: Optional[Tensor] = None
+        self.positions: Optional[Tensor] = None
+        self.attn_mask: Optional[Tensor] = None
+        self.self_attention: Dict[nn.Module, Tuple[Tensor, Tensor]] = {}
+        self.cross_attention: Dict[nn.Module, Tuple[Tensor, Tensor]] = {}
+        self.spares: Dict[nn.Module, Tuple[Tensor, Tensor]] = {}  # see `rearrange()`
+
+    def update(self, module: nn.Module, k: Tensor, v: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Write the keys and values of the positions from `offset` on for the self-attention module,
+        and return the keys and values of all positions up to them; or, for a static cache, write
+        them at `positions` and return the whole buffers.
+        """
+        if module not in self.self_attention:
+            shape = (k.shape[0], self.n_ctx, k.shape[2])
+            # zero-filled, as the positions not written yet are masked but still attended to
+            # when static, and a NaN from uninitialized memory would survive the mask
+            self.self_attention[module] = (k.new_zeros(shape), v.new_zeros(shape))
+
+        key_cache, value_cache = self.self_attention[module]
+        if self.static:
+            key_cache.index_copy_(1, self.positions, k)
+            value_cache.index_copy_(1, self.positions, v)
+            return key_cache, value_cache
+
+        end = self.offset + k.shape[1]
+        if end > self.n_ctx:
+            raise ValueError(f"the cache can hold at most {self.n_ctx} positions")
+
+        key_cache[:, self.offset : end] = k
+        value_cache[:, self.offset : end] = v
+        return key_cache[:, :end], value_cache[:, :end]
+
+    def rearrange(self, source_indices: List[int]) -> None:
+        """Reorder the cached sequences in the batch, e.g. according to the updated beams"""
+        for module, caches in self.self_attention.items():
+            # gather into a second pair of buffers and swap them, which copies the cache only once
+            if module not in self.spares:
+                self.spares[module] = tuple(torch.zeros_like(cache) for cache in caches)
+            spares = self.spares[module]
+
+            index = torch.tensor(source_indices, device=caches[0].device)
+            for cache, spare in zip(caches, spares):
+                torch.index_select(
+                    cache[:, : self.offset], 0, index, out=spare[:, : self.offset]
+                )
+            self.self_attention[module], self.spares[module] = spares, caches
+
+    def truncate(self, offset: int) -> None:
+        """Discard the positions from `offset` on, e.g. for the rejected tokens of a draft"""
+        self.offset = min(self.offset, offset)
+        if self.position is not None:
+            self.position.fill_(self.offset)
+
+    def reset(self) -> None:
+        """Empty the cache, e.g. to decode another audio"""
+        self.offset = 0
+        self.position = self.positions = self.attn_mask = None
+        self.self_attention.clear()
+        self.cross_attention.clear()
+        self.spares.clear()
+
+
 @contextmanager
 def disable_sdpa():
     prev_state = MultiHeadAttention.use_sdpa
@@ -78,7 +209,26 @@ def disable_sdpa():
         MultiHeadAttention.use_sdpa = prev_state
 
 
-class MultiHeadAttention(nn.Module):
+@contextmanager
+def cache_weight_casts(*models: nn.Module):
+    """
+    Convert the weights of the models to the dtype of the activations once per dtype, instead of on
+    every forward pass, e.g. when running a model kept in fp32 with fp16 inputs. The converted
+    copies are detached from the autograd graph and take extra memory until the context exits.
+    """
+    modules = [
+        m for model in models for m in model.modules() if isinstance(m, CastCacheMixin)
+    ]
+    try:
+        for module in modules:
+            module.cast_cache = {}
+        yield
+    finally:
+        for module in modules:
+            module.cast_cache = None
+
+
+class MultiHeadAttention(CastCacheMixin, nn.Module):
     use_sdpa = True
 
     def __init__(self, n_state: int, n_head: int):
@@ -88,17 +238,66 @@ class MultiHeadAttention(nn.Module):
         self.key = Linear(n_state, n_state, bias=False)
         self.value = Linear(n_state, n_state)
         self.out = Linear(n_state, n_state)
+        self.qkv: Optional[Tuple[Tensor, Tensor]] = None  # see `fuse_qkv()`
+
+    def fuse_qkv(self) -> None:
+        """
+        Concatenate the query, key and value projections into a single weight and bias, so that
+        self-attention computes them with one GEMM. The `query`, `key` and `value` parameters become
+        views of the fused tensors, which keeps the state dict unchanged and lets `load_state_dict()`
+        update both; the fusion is redone after `to()`.
+        """
+        linears = [self.query, self.key, self.value]
+        weight = torch.cat([linear.weight.detach() for linear in linears])
+        zeros = torch.zeros_like(self.key.weight[:, 0])
+        biases = [zeros if linear.bias is None else linear.bias for linear in linears]
+        bias = torch.cat(biases).detach()
+
+        n_state = self.query.out_features
+        for i, linear in enumerate(linears):
+            rows = slice(i * n_state, (i + 1) * n_state)
+            linear.weight = nn.Parameter(weight[rows], linear.weight.requires_grad)
+            if linear.bias is not None:
+                linear.bias = nn.Parameter(bias[rows], linear.bias.requires_grad)
+
+        self.qkv = (weight, bias)
+
+    def _apply(self, *args, **kwargs):
+        module = super()._apply(*args, **kwargs)
+        if self.qkv is not None:
+            self.fuse_qkv()
+        return module
 
     def forward(
         self,
         x: Tensor,
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
-        kv_cache: Optional[dict] = None,
+        kv_cache: Optional[Union[dict, KVCache]] = None,
     ):
+        if (
+            xa is None
+            and self.qkv is not None
+            # the hooks of install_kv_cache_hooks() need separate key and value calls
+            and not isinstance(kv_cache, dict)
+        ):
+            weight = self.cast("qkv.weight", x.dtype, self.qkv[0])
+            bias = self.cast("qkv.bias", x.dtype, self.qkv[1])
+            q, k, v = F.linear(x, weight, bias).chunk(3, dim=-1)
+            if kv_cache is not None:
+                k, v = kv_cache.update(self, k, v)
+            return self._attend(q, k, v, xa, mask, self._attn_mask(xa, kv_cache))
+
         q = self.query(x)
 
-        if kv_cache is None or xa is None or self.key not in kv_cache:
+        if isinstance(kv_cache, KVCache):
+            if xa is None:
+                k, v = kv_cache.update(self, self.key(x), self.value(x))
+            else:
+                if self not in kv_cache.cross_attention:
+                    kv_cache.cross_attention[self] = (self.key(xa), self.value(xa))
+                k, v = kv_cache.cross_attention[self]
+        elif kv_cache is None or xa is None or self.key not in kv_cache:
             # hooks, if installed (i.e. kv_cache is not None), will prepend the cached kv tensors;
             # otherwise, perform key/value projections for self- or cross-attention as usual.
             k = self.key(x if xa is None else xa)
@@ -108,27 +307,76 @@ class MultiHeadAttention(nn.Module):
             k = kv_cache[self.key]
             v = kv_cache[self.value]
 
-        wv, qk = self.qkv_attention(q, k, v, mask)
+        return self._attend(q, k, v, xa, mask, self._attn_mask(xa, kv_cache))
+
+    @staticmethod
+    def _attn_mask(xa: Optional[Tensor], kv_cache) -> Optional[Tensor]:
+        """The mask over the whole buffers of a static cache, used instead of the causal one"""
+        if xa is None and isinstance(kv_cache, KVCache) and kv_cache.static:
+            return kv_cache.attn_mask
+        return None
+
+    def _attend(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        xa: Optional[Tensor] = None,
+        mask: Optional[Tensor] = None,
+        attn_mask: Optional[Tensor] = None,
+    ):
+        if xa is not None and q.shape[0] != k.shape[0]:
+            # the queries of a group of sequences decoding the same audio, e.g. the beams, attend
+            # to the same keys and values; fold the group into the query positions to share them.
+            n_batch, n_ctx, n_state = q.shape
+            n_audio = k.shape[0]
+            q = q.reshape(n_audio, -1, n_state)
+            wv, qk = self.qkv_attention(q, k, v, mask)
+            wv = wv.reshape(n_batch, n_ctx, n_state)
+            if qk is not None:
+                qk = qk.unflatten(2, (-1, n_ctx)).transpose(1, 2).flatten(0, 1)
+        else:
+            wv, qk = self.qkv_attention(q, k, v, mask, attn_mask)
+
         return self.out(wv), qk
 
     def qkv_attention(
-        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        mask: Optional[Tensor] = None,
+        attn_mask: Optional[Tensor] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        mask : the causal mask of the decoder, sliced to the number of positions
+        attn_mask : an additive mask of shape (n_ctx, k.shape[1]) to apply instead of `mask`
+        """
         n_batch, n_ctx, n_state = q.shape
         scale = (n_state // self.n_head) ** -0.25
+
+        n_kv = k.shape[1]
+        if attn_mask is None and mask is not None and 1 < n_ctx < n_kv:
+            # the queries are the last positions, following the cached ones
+            attn_mask = mask[n_kv - n_ctx : n_kv, :n_kv]
         q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
         if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
-            a = scaled_dot_product_attention(
-                q, k, v, is_causal=mask is not None and n_ctx > 1
-            )
+            if attn_mask is not None:
+                a = scaled_dot_product_attention(q, k, v, attn_mask.to(q.dtype))
+            else:
+                a = scaled_dot_product_attention(
+                    q, k, v, is_causal=mask is not None and n_ctx > 1
+                )
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
-            if mask is not None:
+            if attn_mask is not None:
+                qk = qk + attn_mask
+            elif mask is not None:
                 qk = qk + mask[:n_ctx, :n_ctx]
             qk = qk.float()
 
@@ -162,7 +410,7 @@ class ResidualAttentionBlock(nn.Module):
         x: Tensor,
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
-        kv_cache: Optional[dict] = None,
+        kv_cache: Optional[Union[dict, KVCache]] = None,
     ):
         x = x + self.attn(self.attn_ln(x), mask=mask, kv_cache=kv_cache)[0]
         if self.cross_attn:
@@ -187,15 +435,18 @@ class AudioEncoder(nn.Module):
 
     def forward(self, x: Tensor):
         """
-        x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
-            the mel spectrogram of the audio
+        x : torch.Tensor, shape = (batch_size, n_mels, <= 2 * n_ctx)
+            the mel spectrogram of the audio, usually of 30 seconds; a shorter one is encoded with
+            the leading part of the positional embedding, which saves compute in proportion but
+            was not seen in training, so the transcription may be less accurate
         """
         x = F.gelu(self.conv1(x))
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
 
-        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        n_ctx, n_state = self.positional_embedding.shape
+        assert x.shape[2] == n_state and x.shape[1] <= n_ctx, "incorrect audio shape"
+        x = (x + self.positional_embedding[: x.shape[1]]).to(x.dtype)
 
         for block in self.blocks:
             x = block(x)
@@ -204,7 +455,7 @@ class AudioEncoder(nn.Module):
         return x
 
 
-class TextDecoder(nn.Module):
+class TextDecoder(CastCacheMixin, nn.Module):
     def __init__(
         self, n_vocab: int, n_ctx: int, n_state: int, n_head: int, n_layer: int
     ):
@@ -221,30 +472,82 @@ class TextDecoder(nn.Module):
         )
         self.ln = LayerNorm(n_state)
 
+        # a separate module for the projection onto the vocabulary, which is tied to the token
+        # embedding unless replaced, e.g. by a quantized copy in `quantize_int8()`
+        self.output_projection: Optional[nn.Module] = None
+
+    def _init_buffers(self):
+        """Create the buffers that are not in the state dict; see `Whisper._init_buffers()`"""
+        n_ctx = self.positional_embedding.shape[0]
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
-    def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
+    def forward(
+        self,
+        x: Tensor,
+        xa: Tensor,
+        kv_cache: Optional[Union[dict, KVCache]] = None,
+        positions: Optional[List[int]] = None,
+    ):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
-        xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
-            the encoded audio features to be attended on
+        xa : torch.Tensor, shape = (n_audio, n_audio_ctx, n_audio_state)
+            the encoded audio features to be attended on, where batch_size can be a multiple of
+            n_audio for decoding a group of consecutive sequences, e.g. beams, for each audio
+        kv_cache : Union[dict, KVCache], optional
+            the cached keys and values of the previous tokens, either a `KVCache` or a dictionary
+            populated by the hooks of `Whisper.install_kv_cache_hooks()`
+        positions : List[int], optional
+            the indices of the tokens in x to return the logits for, instead of all of them, which
+            skips the projection onto the vocabulary for the other positions
         """
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
-        x = (
-            self.token_embedding(x)
-            + self.positional_embedding[offset : offset + x.shape[-1]]
-        )
+        if isinstance(kv_cache, KVCache) and kv_cache.static:
+            # index the embeddings and the cache with tensors, so that no shape depends on them
+            if kv_cache.position is None:
+                kv_cache.position = torch.zeros((), dtype=torch.long, device=x.device)
+            cache_positions = kv_cache.position + torch.arange(
+                x.shape[-1], device=x.device
+            )
+            n_cache = kv_cache.n_ctx
+            kv_cache.positions = cache_positions
+            kv_cache.attn_mask = torch.zeros(
+                x.shape[-1], n_cache, device=x.device
+            ).masked_fill_(
+                torch.arange(n_cache, device=x.device) > cache_positions[:, None],
+                -np.inf,
+            )
+            positional_embedding = self.positional_embedding[cache_positions]
+        else:
+            if isinstance(kv_cache, KVCache):
+                offset = kv_cache.offset
+            else:
+                offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+            positional_embedding = self.positional_embedding[
+                offset : offset + x.shape[-1]
+            ]
+        x = self.token_embedding(x) + positional_embedding
         x = x.to(xa.dtype)
 
         for block in self.blocks:
             x = block(x, xa, mask=self.mask, kv_cache=kv_cache)
 
+        if isinstance(kv_cache, KVCache):
+            if kv_cache.static:
+                kv_cache.position.add_(x.shape[1])
+            else:
+                kv_cache.offset += x.shape[1]
+
+        if positions is not None:
+            x = x[:, positions]
+
         x = self.ln(x)
-        logits = (
-            x @ torch.transpose(self.token_embedding.weight.to(x.dtype), 0, 1)
-        ).float()
+        if self.output_projection is not None:
+            logits = self.output_projection(x).float()
+        else:
+            logits = (
+                x @ torch.transpose(self.cast("token_embedding.weight", x.dtype), 0, 1)
+            ).float()
 
         return logits
 
@@ -267,10 +570,22 @@ class Whisper(nn.Module):
             self.dims.n_text_head,
             self.dims.n_text_layer,
         )
+        self._init_buffers()
+
+    def _init_buffers(self):
+        """
+        Create the buffers that are not in the state dict, e.g. again on the CPU after the model
+        was constructed on the meta device and the state dict was assigned to it
+        """
+        self.decoder._init_buffers()
+
         # use the last half among the decoder layers for time alignment by default;
         # to use a specific set of heads, see `set_alignment_heads()` below.
         all_heads = torch.zeros(
-            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
+            self.dims.n_text_layer,
+            self.dims.n_text_head,
+            dtype=torch.bool,
+            device="cpu",  # not on the meta device, which may not support sparse tensors
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
         self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
@@ -307,12 +622,23 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
+    def fuse_qkv(self):
+        """
+        Fuse the query, key and value projections of the self-attention layers into one GEMM each;
+        see `MultiHeadAttention.fuse_qkv()`. This is most useful on CPU with small batches, where
+        the overhead of each GEMM call dominates the decoder step.
+        """
+        for block in [*self.encoder.blocks, *self.decoder.blocks]:
+            block.attn.fuse_qkv()
+        return self
+
     def install_kv_cache_hooks(self, cache: Optional[dict] = None):
         """
         The `MultiHeadAttention` module optionally accepts `kv_cache` which stores the key and value
         tensors calculated for the previous positions. This method returns a dictionary that stores
         all caches, and the necessary hooks for the key and value projection modules that save the
-        intermediate tensors to be reused during later calculations.
+        intermediate tensors to be reused during later calculations. A `KVCache` can be passed as
+        `kv_cache` instead, which needs no hooks and does not copy the whole cache at every step.
 
         Returns
         -------
@@ -343,3 +669,78 @@ class Whisper(nn.Module):
     detect_language = detect_language_function
     transcribe = transcribe_function
     decode = decode_function
+
+
+def _quantize_weight(weight: Tensor) -> Tensor:
+    """Quantize a weight to int8 per output channel, i.e. per row"""
+    from torch.ao.quantization import default_per_channel_weight_observer
+
+    weight = weight.detach().float()
+    observer = default_per_channel_weight_observer()
+    observer(weight)
+    scales, zero_points = observer.calculate_qparams()
+    return torch.quantize_per_channel(
+        weight, scales.double(), zero_points.long(), 0, torch.qint8
+    )
+
+
+def _quantized_linear(weight: Tensor, bias: Optional[Tensor]) -> nn.Module:
+    """A dynamically quantized linear layer, with a weight quantized by `_quantize_weight()`"""
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+    out_features, in_features = weight.shape
+    quantized = DynamicQuantizedLinear(
+        in_features, out_features, bias_=bias is not None, dtype=torch.qint8
+    )
+    quantized.set_weight_bias(weight, None if bias is None else bias.detach().float())
+    return quantized
+
+
+def _quantize_linear(linear: nn.Linear) -> nn.Module:
+    return _quantized_linear(_quantize_weight(linear.weight), linear.bias)
+
+
+class QuantizedEmbedding(nn.Module):
+    """
+    An embedding with int8 weights quantized per row, e.g. by `_quantize_weight()`; only the rows
+    that are looked up are converted to fp32.
+    """
+
+    def __init__(self, weight: Tensor):
+        super().__init__()
+        self.register_buffer("weight", weight.int_repr())
+        self.register_buffer("scales", weight.q_per_channel_scales().float())
+        self.register_buffer("zero_points", weight.q_per_channel_zero_points())
+
+    def forward(self, x: Tensor) -> Tensor:
+        rows = self.weight[x].float() - self.zero_points[x, None]
+        return rows * self.scales[x, None]
+
+
+def quantize_int8(model: Whisper) -> Whisper:
+    """
+    Replace the linear layers of the attention and MLP blocks, and the projection onto the
+    vocabulary, with dynamically quantized int8 ones for CPU inference; the weights are quantized
+    per output channel, and the activations per batch at runtime. The token embedding looks up the
+    same int8 weights as the projection onto the vocabulary; the convolutions, the positional
+    embeddings and the LayerNorms stay in fp32. The model should be on the CPU and is modified in
+    place.
+    """
+    if model.device.type != "cpu":
+        raise ValueError("int8 quantization is only supported on CPU")
+
+    for block in [*model.encoder.blocks, *model.decoder.blocks]:
+        for attn in filter(None, [block.attn, block.cross_attn]):
+            for name in ["query", "key", "value", "out"]:
+                setattr(attn, name, _quantize_linear(getattr(attn, name)))
+            attn.qkv = None
+        for i, layer in enumerate(block.mlp):
+            if isinstance(layer, nn.Linear):
+                block.mlp[i] = _quantize_linear(layer)
+
+    # the packed weights of the projection cannot be indexed, so the embedding keeps an int8 copy
+    weight = _quantize_weight(model.decoder.token_embedding.weight)
+    model.decoder.output_projection = _quantized_linear(weight, None)
+    model.decoder.token_embedding = QuantizedEmbedding(weight)
+
+    return model
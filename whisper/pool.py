@@ -0,0 +1,155 @@
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional, Tuple, Union
+
+import torch
+
+from .decoding import DTYPES
+
+if TYPE_CHECKING:
+    from .model import Whisper
+
+ModelKey = Tuple[str, str, Optional[str]]  # (name, device, dtype)
+
+
+def model_size(model: torch.nn.Module) -> int:
+    """Returns the number of bytes taken by the parameters and buffers of the model"""
+    tensors = [*model.parameters(), *model.buffers()]
+    return sum(t.numel() * t.element_size() for t in tensors if not t.is_sparse)
+
+
+class ModelPool:
+    """
+    An in-process cache of loaded Whisper models, keyed by the model name, the device and the
+    dtype, e.g. for serving several model sizes. When the total size of the cached models exceeds
+    `memory_budget` bytes, the least recently used ones are evicted; a model that is still
+    referenced elsewhere stays alive until it is released. `preload()` loads a model in a
+    background thread; `get()` waits for a model being loaded by `preload()` or by another
+    thread calling `get()`, instead of loading the same model twice.
+    The `hits`, `misses` and `evictions` counters keep track of how the pool is used.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None, **load_options):
+        self.memory_budget = memory_budget
+        self.load_options = load_options  # passed to `whisper.load_model()`
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._models: "OrderedDict[ModelKey, Tuple[Whisper, int]]" = OrderedDict()
+        self._loading: Dict[ModelKey, Future] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @staticmethod
+    def _key(
+        name: str, device: Optional[Union[str, torch.device]], dtype: Optional[str]
+    ) -> ModelKey:
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if dtype is not None and dtype not in DTYPES:
+            raise ValueError(f"dtype should be one of {list(DTYPES)}")
+        return name, str(torch.device(device)), dtype
+
+    def _load(self, key: ModelKey) -> "Whisper":
+        from . import load_model
+
+        name, device, dtype = key
+        model = load_model(name, device=device, **self.load_options)
+        if dtype is not None:
+            model = model.to(DTYPES[dtype])
+        return model
+
+    def _add(self, key: ModelKey, model: "Whisper"):
+        with self._lock:
+            self._loading.pop(key, None)
+            self._models[key] = (model, model_size(model))
+            self._evict(keep=key)
+
+    def _evict(self, keep: ModelKey):
+        if self.memory_budget is None:
+            return
+
+        total = sum(size for _, size in self._models.values())
+        for key in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if key != keep:
+                total -= self._models.pop(key)[1]
+                self.evictions += 1
+
+        if total > self.memory_budget:
+            warnings.warn(f"{keep[0]} alone exceeds the memory budget of the pool")
+
+    def get(
+        self,
+        name: str,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: Optional[str] = None,
+    ) -> "Whisper":
+        """Returns the model, loading it if it is not in the pool"""
+        key = self._key(name, device, dtype)
+        with self._lock:
+            if key in self._models:
+                self.hits += 1
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            self.misses += 1
+            future = self._loading.get(key)
+            if loading := future is None:
+                future = self._loading[key] = Future()
+
+        if loading:
+            self._fill(key, future)
+        # otherwise, wait for the thread loading it, which adds it to the pool when done
+        return future.result()
+
+    def preload(
+        self,
+        name: str,
+        device: Optional[Union[str, torch.device]] = None,
+        dtype: Optional[str] = None,
+    ) -> Future:
+        """Starts loading the model in a background thread, if it is not in the pool yet"""
+        key = self._key(name, device, dtype)
+        with self._lock:
+            if key in self._models:
+                future = Future()
+                future.set_result(self._models[key][0])
+                return future
+            if key in self._loading:
+                return self._loading[key]
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    1, thread_name_prefix="whisper-pool"
+                )
+            future = self._loading[key] = Future()
+            self._executor.submit(self._fill, key, future)
+            return future
+
+    def _fill(self, key: ModelKey, future: Future):
+        """Loads the model, adds it to the pool and then resolves the future of the loading"""
+        try:
+            model = self._load(key)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            future.set_exception(e)
+            return
+
+        self._add(key, model)
+        future.set_result(model)
+
+    def __contains__(self, key: ModelKey) -> bool:
+        return self._key(*key) in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def clear(self):
+        """Removes all models from the pool"""
+        with self._lock:
+            self._models.clear()
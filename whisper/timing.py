@@ -1,10 +1,10 @@
+import functools
 import itertools
 import subprocess
 import warnings
 from dataclasses import dataclass
 from typing import TYPE_CHECKING, List
 
-import numba
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -54,7 +54,31 @@ def median_filter(x: torch.Tensor, filter_width: int):
     return result
 
 
-@numba.jit(nopython=True)
+def lazy_jit(**options):
+    """
+    Like `numba.jit(**options)`, but numba is only imported, and the function compiled,
+    on its first call; this keeps numba out of `import whisper`.
+    Calls from other jitted functions are not supported, as the wrapper is a Python function.
+    """
+
+    def decorator(func):
+        compiled = None
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            nonlocal compiled
+            if compiled is None:
+                import numba
+
+                compiled = numba.jit(**options)(func)
+            return compiled(*args)
+
+        return wrapper
+
+    return decorator
+
+
+@lazy_jit(nopython=True, cache=True)
 def backtrace(trace: np.ndarray):
     i = trace.shape[0] - 1
     j = trace.shape[1] - 1
@@ -79,8 +103,8 @@ def backtrace(trace: np.ndarray):
     return result[::-1, :].T
 
 
-@numba.jit(nopython=True, parallel=True)
-def dtw_cpu(x: np.ndarray):
+@lazy_jit(nopython=True, parallel=True, cache=True)
+def dtw_cpu_trace(x: np.ndarray):
     N, M = x.shape
     cost = np.ones((N + 1, M + 1), dtype=np.float32) * np.inf
     trace = -np.ones((N + 1, M + 1), dtype=np.float32)
@@ -102,7 +126,11 @@ def dtw_cpu(x: np.ndarray):
             cost[i, j] = x[i - 1, j - 1] + c
             trace[i, j] = t
 
-    return backtrace(trace)
+    return trace
+
+
+def dtw_cpu(x: np.ndarray):
+    return backtrace(dtw_cpu_trace(x))
 
 
 def dtw_cuda(x, BLOCK_SIZE=1024):
@@ -3,9 +3,10 @@ import os
 import string
 from dataclasses import dataclass, field
 from functools import cached_property, lru_cache
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import tiktoken
+if TYPE_CHECKING:
+    import tiktoken
 
 LANGUAGES = {
     "en": "english",
@@ -132,7 +133,7 @@ TO_LANGUAGE_CODE = {
 class Tokenizer:
     """A thin wrapper around `tiktoken` providing quick access to special tokens"""
 
-    encoding: tiktoken.Encoding
+    encoding: "tiktoken.Encoding"
     num_languages: int
     language: Optional[str] = None
     task: Optional[str] = None
@@ -329,6 +330,8 @@ class Tokenizer:
 
 @lru_cache(maxsize=None)
 def get_encoding(name: str = "gpt2", num_languages: int = 99):
+    import tiktoken
+
     vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
     ranks = {
         base64.b64decode(token): int(rank)
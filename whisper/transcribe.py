@@ -1,12 +1,25 @@
 import argparse
+import itertools
+import multiprocessing
 import os
 import traceback
 import warnings
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import torch
-import tqdm
 
 from .audio import (
     FRAMES_PER_SECOND,
@@ -14,10 +27,11 @@ from .audio import (
     N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    load_audio,
     log_mel_spectrogram,
     pad_or_trim,
 )
-from .decoding import DecodingOptions, DecodingResult
+from .decoding import DTYPES, DecodingOptions, DecodingResult
 from .timing import add_word_timestamps
 from .tokenizer import LANGUAGES, TO_LANGUAGE_CODE, get_tokenizer
 from .utils import (
@@ -30,6 +44,7 @@ from .utils import (
     optional_int,
     str2bool,
 )
+from .vad import detect_speech
 
 if TYPE_CHECKING:
     from .model import Whisper
@@ -52,6 +67,12 @@ def transcribe(
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
+    mel_normalization: str = "global",
+    cache_dir: Optional[str] = None,
+    mel: Optional[Union[np.ndarray, torch.Tensor]] = None,
+    vad: bool = False,
+    split_channels: bool = False,
+    short_audio: bool = False,
     **decode_options,
 ):
     """
@@ -119,37 +140,220 @@ def transcribe(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    mel_normalization: str
+        How the log-Mel spectrogram is normalized, either "global" or "running"; the latter does
+        not depend on audio after each frame, see `log_mel_spectrogram` for the tradeoff.
+
+    cache_dir: Optional[str]
+        If given and `audio` is a path, cache the decoded audio and its log-Mel spectrogram in this
+        directory, so that transcribing the same file again skips the feature extraction
+
+    mel: Optional[Union[np.ndarray, torch.Tensor]]
+        The log-Mel spectrogram of `audio` padded with 30 seconds of silence, if it was computed
+        beforehand, e.g. in another process; `audio` is then only used for reporting
+
+    vad: bool
+        Whether to detect the speech regions from the energy and spectral flatness of the audio
+        beforehand, and to transcribe only those within `clip_timestamps`, so that long silences
+        are skipped without running the model on them. The regions are padded to keep the onsets,
+        but very quiet speech may be dropped; see `whisper.vad.detect_speech`
+
+    split_channels: bool
+        Whether to transcribe each channel of the audio separately, e.g. for recordings with one
+        speaker per channel, instead of downmixing them. The segments of all channels are encoded
+        together in a batch, and the decoded channels are not interleaved in the verbose output.
+        `audio` may then be a (channels, samples) waveform, and `mel` a (channels, n_mels, frames)
+        spectrogram.
+
+    short_audio: bool
+        Whether to encode a window shorter than 30 seconds, i.e. a short clip or the end of the
+        audio, as it is instead of padding it with silence, which cuts the encoder compute in
+        proportion, e.g. 10x for a 3-second clip. The model was trained on 30-second windows, so
+        this is a tradeoff against accuracy: words may be dropped or repeated more often near the
+        end of the clip, and the results should be validated on the target audio before relying on
+        it. The decoder cross-attends only to the encoded frames.
+
     Returns
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
-    the spoken language ("language"), which is detected when `decode_options["language"]` is None.
+    the spoken language ("language"), which is detected when `decode_options["language"]` is None,
+    or None if `vad` found no speech to detect it from.
+    If `split_channels` is True, a list of such dictionaries for each channel.
     """
-    dtype = torch.float16 if decode_options.get("fp16", True) else torch.float32
+    options = dict(
+        verbose=verbose,
+        temperature=temperature,
+        compression_ratio_threshold=compression_ratio_threshold,
+        logprob_threshold=logprob_threshold,
+        no_speech_threshold=no_speech_threshold,
+        condition_on_previous_text=condition_on_previous_text,
+        initial_prompt=initial_prompt,
+        carry_initial_prompt=carry_initial_prompt,
+        word_timestamps=word_timestamps,
+        prepend_punctuations=prepend_punctuations,
+        append_punctuations=append_punctuations,
+        clip_timestamps=clip_timestamps,
+        hallucination_silence_threshold=hallucination_silence_threshold,
+        mel_normalization=mel_normalization,
+        cache_dir=cache_dir,
+        vad=vad,
+        short_audio=short_audio,
+        **decode_options,
+    )
+
+    if not split_channels:
+        return _run_transcriptions(
+            model, [_transcribe(model, audio, mel=mel, **options)]
+        )[0]
+
+    if mel is not None:
+        if mel.ndim != 3:
+            raise ValueError(
+                "split_channels requires a (channels, n_mels, frames) spectrogram, "
+                f"got an array of shape {tuple(mel.shape)}"
+            )
+        channels = [dict(audio=audio, mel=channel_mel) for channel_mel in mel]
+    else:
+        if isinstance(audio, str):
+            audio = load_audio(audio, mono=False, cache_dir=cache_dir)
+        if audio.ndim != 2:
+            raise ValueError(
+                "split_channels requires a (channels, samples) waveform, "
+                f"got an array of shape {tuple(audio.shape)}"
+            )
+        channels = [dict(audio=channel_audio, mel=None) for channel_audio in audio]
+
+    return _run_transcriptions(
+        model, [_transcribe(model, **channel, **options) for channel in channels]
+    )
+
+
+def _run_transcriptions(
+    model: "Whisper", transcriptions: List[Generator[torch.Tensor, torch.Tensor, dict]]
+) -> List[dict]:
+    """Run the `_transcribe` generators to completion, encoding their mel segments in batches"""
+    results: List[Optional[dict]] = [None] * len(transcriptions)
+    mel_segments: Dict[int, torch.Tensor] = {}
+
+    def advance(index: int, audio_features: Optional[torch.Tensor] = None):
+        try:
+            mel_segments[index] = transcriptions[index].send(audio_features)
+        except StopIteration as stop:
+            mel_segments.pop(index, None)
+            results[index] = stop.value
+
+    for index in range(len(transcriptions)):
+        advance(index)
+
+    while mel_segments:
+        # segments shorter than 30 seconds, with short_audio, are batched by their length
+        batches: Dict[int, List[int]] = {}
+        for index, mel_segment in mel_segments.items():
+            batches.setdefault(mel_segment.shape[-1], []).append(index)
+        for indices in batches.values():
+            with torch.no_grad():
+                audio_features = model.embed_audio(
+                    torch.stack([mel_segments[index] for index in indices])
+                )
+            for index, features in zip(indices, audio_features):
+                advance(index, features)
+
+    return results
+
+
+def _transcribe(
+    model: "Whisper",
+    audio: Union[str, np.ndarray, torch.Tensor],
+    *,
+    verbose: Optional[bool],
+    temperature: Union[float, Tuple[float, ...]],
+    compression_ratio_threshold: Optional[float],
+    logprob_threshold: Optional[float],
+    no_speech_threshold: Optional[float],
+    condition_on_previous_text: bool,
+    initial_prompt: Optional[str],
+    carry_initial_prompt: bool,
+    word_timestamps: bool,
+    prepend_punctuations: str,
+    append_punctuations: str,
+    clip_timestamps: Union[str, List[float]],
+    hallucination_silence_threshold: Optional[float],
+    mel_normalization: str,
+    cache_dir: Optional[str],
+    mel: Optional[Union[np.ndarray, torch.Tensor]],
+    vad: bool,
+    short_audio: bool,
+    **decode_options,
+) -> Generator[torch.Tensor, torch.Tensor, dict]:
+    """
+    The transcription loop of `transcribe` for a single channel, as a generator which yields each
+    mel segment to encode, and expects to be sent the encoded audio features of that segment;
+    this allows encoding the segments of multiple channels together. Returns the result dict.
+    The options are those of `transcribe`, which passes all of them.
+    """
+    dtype_name = decode_options.get("dtype") or (
+        "fp16" if decode_options.get("fp16", True) else "fp32"
+    )
+    if dtype_name not in DTYPES:
+        raise ValueError(f"dtype should be one of {list(DTYPES)}")
     if model.device == torch.device("cpu"):
         if torch.cuda.is_available():
             warnings.warn("Performing inference on CPU when CUDA is available")
-        if dtype == torch.float16:
+        if dtype_name == "fp16":
             warnings.warn("FP16 is not supported on CPU; using FP32 instead")
-            dtype = torch.float32
-
-    if dtype == torch.float32:
-        decode_options["fp16"] = False
-
-    # Pad 30-seconds of silence to the input audio, for slicing
-    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+            dtype_name = "fp32"
+
+    decode_options["dtype"] = dtype_name
+    dtype = DTYPES[dtype_name]
+
+    if mel is None:
+        # Pad 30-seconds of silence to the input audio, for slicing; the spectrogram is computed
+        # in 30-second chunks to keep the memory bounded for long audio
+        mel = log_mel_spectrogram(
+            audio,
+            model.dims.n_mels,
+            padding=N_SAMPLES,
+            chunk_size=N_FRAMES,
+            normalization=mel_normalization,
+            cache_dir=cache_dir,
+        )
+    elif not torch.is_tensor(mel):
+        mel = torch.from_numpy(mel)
+    if mel.shape[-2] != model.dims.n_mels:
+        raise ValueError(
+            f"mel should have {model.dims.n_mels} Mel bins, got {mel.shape[-2]}"
+        )
     content_frames = mel.shape[-1] - N_FRAMES
     content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
 
+    speech_clips: Optional[List[Tuple[int, int]]] = None
+    if vad:
+        speech_clips = [
+            (round(start * FRAMES_PER_SECOND), round(end * FRAMES_PER_SECOND))
+            for start, end in detect_speech(mel[:, :content_frames])
+        ]
+
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
             decode_options["language"] = "en"
+        elif speech_clips == []:
+            # nothing to detect the language from, nor to transcribe
+            return dict(text="", segments=[], language=None)
         else:
             if verbose:
                 print(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
-            mel_segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
-            _, probs = model.detect_language(mel_segment)
+            speech_start = speech_clips[0][0] if speech_clips else 0
+            speech_end = speech_start + N_FRAMES
+            if short_audio:
+                speech_end = min(speech_end, max(content_frames, speech_start + 1))
+            mel_segment = mel[:, speech_start:speech_end]
+            if not short_audio:
+                mel_segment = pad_or_trim(mel_segment, N_FRAMES)
+            mel_segment = mel_segment.to(model.device).to(dtype)
+            audio_features = yield mel_segment
+            _, probs = model.detect_language(audio_features, encoded=True)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -175,30 +379,48 @@ def transcribe(
     if len(seek_points) % 2 == 1:
         seek_points.append(content_frames)
     seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
+    if speech_clips is not None:
+        # transcribe only the speech within the requested clips
+        seek_clips = [
+            (max(start, speech_start), min(end, speech_end))
+            for start, end in seek_clips
+            for speech_start, speech_end in speech_clips
+            if max(start, speech_start) < min(end, speech_end)
+        ] or [(content_frames, content_frames)]
 
     punctuation = "\"'“¿([{-\"'.。,，!！?？:：”)]}、"
 
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
+    def decode_with_fallback(
+        audio_features: torch.Tensor, mel_segment: torch.Tensor
+    ) -> DecodingResult:
         temperatures = (
             [temperature] if isinstance(temperature, (int, float)) else temperature
         )
         decode_result = None
 
+        draft_audio_features = None
+        if (draft_model := decode_options.get("draft_model")) is not None:
+            with torch.no_grad():
+                draft_audio_features = draft_model.embed_audio(mel_segment[None])[0]
+
         for t in temperatures:
             kwargs = {**decode_options}
             if t > 0:
-                # disable beam_size and patience when t > 0
+                # disable beam_size, patience and the greedy-only draft_model when t > 0
                 kwargs.pop("beam_size", None)
                 kwargs.pop("patience", None)
+                kwargs.pop("draft_model", None)
             else:
                 # disable best_of when t == 0
                 kwargs.pop("best_of", None)
 
             options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
+            decode_result = model.decode(
+                audio_features, options, draft_audio_features, encoded=True
+            )
 
             needs_fallback = False
             if (
@@ -260,6 +482,8 @@ def transcribe(
             "no_speech_prob": result.no_speech_prob,
         }
 
+    import tqdm
+
     # show the progress bar when verbose is False (if True, transcribed text will be printed)
     with tqdm.tqdm(
         total=content_frames, unit="frames", disable=verbose is not False
@@ -283,7 +507,9 @@ def transcribe(
             segment_size = min(N_FRAMES, content_frames - seek, seek_clip_end - seek)
             mel_segment = mel[:, seek : seek + segment_size]
             segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
-            mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
+            if not short_audio:
+                mel_segment = pad_or_trim(mel_segment, N_FRAMES)
+            mel_segment = mel_segment.to(model.device).to(dtype)
 
             if carry_initial_prompt:
                 nignored = max(len(initial_prompt_tokens), prompt_reset_since)
@@ -292,7 +518,8 @@ def transcribe(
             else:
                 decode_options["prompt"] = all_tokens[prompt_reset_since:]
 
-            result: DecodingResult = decode_with_fallback(mel_segment)
+            audio_features = yield mel_segment
+            result: DecodingResult = decode_with_fallback(audio_features, mel_segment)
             tokens = torch.tensor(result.tokens)
 
             if no_speech_threshold is not None:
@@ -514,6 +741,84 @@ def transcribe(
     )
 
 
+def _init_decode_worker():
+    # the workers run alongside the model, so they shouldn't compete with it for all cores
+    torch.set_num_threads(1)
+
+
+def _decode_worker(audio_path: str, n_mels: int, cache_dir: Optional[str]):
+    mel = log_mel_spectrogram(
+        audio_path,
+        n_mels,
+        padding=N_SAMPLES,
+        chunk_size=N_FRAMES,
+        cache_dir=cache_dir,
+    )
+    return mel.numpy()  # pickled as a plain buffer, without sharing torch storages
+
+
+def prefetch_mels(
+    audio_paths: Iterable[str],
+    n_mels: int,
+    prefetch: int = 2,
+    workers: int = 1,
+    cache_dir: Optional[str] = None,
+) -> Iterator[Tuple[str, Optional[Future]]]:
+    """
+    Decode the audio files and compute their padded log-Mel spectrograms in background processes,
+    up to `prefetch` files ahead of the one being consumed.
+
+    Parameters
+    ----------
+    audio_paths: Iterable[str]
+        The paths to the audio files, in the order to transcribe them
+
+    n_mels: int
+        The number of Mel-frequency filters of the model
+
+    prefetch: int
+        The number of files to decode ahead of the current one; 0 disables the background decoding
+
+    workers: int
+        The number of decoding processes
+
+    cache_dir: Optional[str]
+        The feature cache directory, see `transcribe`
+
+    Returns
+    -------
+    An iterator of pairs of each path and a future of its spectrogram as a NumPy array, which can
+    be given to `transcribe` as `mel`; the future is None if `prefetch` is 0.
+    """
+    if prefetch <= 0:
+        for audio_path in audio_paths:
+            yield audio_path, None
+        return
+
+    # spawn, since forking a process that has already initialized torch threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        workers, mp_context=context, initializer=_init_decode_worker
+    ) as pool:
+        pending = deque()
+
+        def submit(audio_path: str):
+            future = pool.submit(_decode_worker, audio_path, n_mels, cache_dir)
+            pending.append((audio_path, future))
+
+        audio_paths = iter(audio_paths)
+        try:
+            for audio_path in itertools.islice(audio_paths, prefetch):
+                submit(audio_path)
+            while pending:
+                for audio_path in itertools.islice(audio_paths, 1):
+                    submit(audio_path)
+                yield pending.popleft()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
 def cli():
     from . import available_models
 
@@ -528,8 +833,10 @@ def cli():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("audio", nargs="+", type=str, help="audio file(s) to transcribe")
     parser.add_argument("--model", default="turbo", type=valid_model_name, help="name of the Whisper model to use")
+    parser.add_argument("--draft_model", default=None, type=valid_model_name, help="name of a smaller Whisper model with the same tokenizer, to propose tokens for speculative greedy decoding, which disables beam search")
     parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
     parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to use for PyTorch inference")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"], help="quantize the linear layers of the model for faster CPU inference with less memory")
     parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
     parser.add_argument("--output_format", "-f", type=str, default="all", choices=["txt", "vtt", "srt", "tsv", "json", "all"], help="format of the output file; if not specified, all available formats will be produced")
     parser.add_argument("--verbose", type=str2bool, default=True, help="whether to print out the progress and debug messages")
@@ -549,6 +856,7 @@ def cli():
 
     parser.add_argument("--condition_on_previous_text", type=str2bool, default=True, help="if True, provide the previous output of the model as a prompt for the next window; disabling may make the text inconsistent across windows, but the model becomes less prone to getting stuck in a failure loop")
     parser.add_argument("--fp16", type=str2bool, default=True, help="whether to perform inference in fp16; True by default")
+    parser.add_argument("--dtype", type=str, default=None, choices=["fp32", "fp16", "bf16"], help="the precision to perform inference in; overrides --fp16 if given, and bf16 also runs on CPU")
 
     parser.add_argument("--temperature_increment_on_fallback", type=optional_float, default=0.2, help="temperature to increase when falling back when the decoding fails to meet either of the thresholds below")
     parser.add_argument("--compression_ratio_threshold", type=optional_float, default=2.4, help="if the gzip compression ratio is higher than this value, treat the decoding as failed")
@@ -564,14 +872,21 @@ def cli():
     parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
     parser.add_argument("--clip_timestamps", type=str, default="0", help="comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process, where the last end timestamp defaults to the end of the file")
     parser.add_argument("--hallucination_silence_threshold", type=optional_float, help="(requires --word_timestamps True) skip silent periods longer than this threshold (in seconds) when a possible hallucination is detected")
+    parser.add_argument("--cache_dir", type=str, default=None, help="optional directory to cache the decoded audio and log-Mel spectrograms in, for transcribing the same files repeatedly")
+    parser.add_argument("--short_audio", type=str2bool, default=False, help="whether to encode windows shorter than 30 seconds without padding them, which is faster for short clips but may be less accurate")
+    parser.add_argument("--vad", type=str2bool, default=False, help="whether to detect speech from the audio energy and spectral flatness, and to transcribe only the speech regions within --clip_timestamps")
+    parser.add_argument("--prefetch", type=int, default=0, help="number of audio files to decode ahead in background processes while the model transcribes the current one; 0 disables prefetching")
+    parser.add_argument("--decode_workers", type=int, default=1, help="number of background processes decoding audio files when --prefetch is positive")
     # fmt: on
 
     args = parser.parse_args().__dict__
     model_name: str = args.pop("model")
     model_dir: str = args.pop("model_dir")
+    draft_model_name: Optional[str] = args.pop("draft_model")
     output_dir: str = args.pop("output_dir")
     output_format: str = args.pop("output_format")
     device: str = args.pop("device")
+    quantize: Optional[str] = args.pop("quantize")
     os.makedirs(output_dir, exist_ok=True)
 
     if model_name.endswith(".en") and args["language"] not in {"en", "English"}:
@@ -590,9 +905,22 @@ def cli():
     if (threads := args.pop("threads")) > 0:
         torch.set_num_threads(threads)
 
+    if draft_model_name is not None:
+        if args["patience"] is not None:
+            parser.error(
+                "--patience requires beam search, which --draft_model disables"
+            )
+        args["beam_size"] = None  # speculative decoding is greedy
+
     from . import load_model
 
-    model = load_model(model_name, device=device, download_root=model_dir)
+    model = load_model(
+        model_name, device=device, download_root=model_dir, quantize=quantize
+    )
+    if draft_model_name is not None:
+        args["draft_model"] = load_model(
+            draft_model_name, device=device, download_root=model_dir, quantize=quantize
+        )
 
     writer = get_writer(output_format, output_dir)
     word_options = [
@@ -610,9 +938,21 @@ def cli():
     if args["max_words_per_line"] and args["max_line_width"]:
         warnings.warn("--max_words_per_line has no effect with --max_line_width")
     writer_args = {arg: args.pop(arg) for arg in word_options}
-    for audio_path in args.pop("audio"):
+    if (decode_workers := args.pop("decode_workers")) < 1:
+        parser.error("--decode_workers should be at least 1")
+    audio_paths = prefetch_mels(
+        args.pop("audio"),
+        model.dims.n_mels,
+        prefetch=args.pop("prefetch"),
+        workers=decode_workers,
+        cache_dir=args["cache_dir"],
+    )
+    for audio_path, mel in audio_paths:
         try:
-            result = transcribe(model, audio_path, temperature=temperature, **args)
+            mel = mel.result() if mel is not None else None
+            result = transcribe(
+                model, audio_path, temperature=temperature, mel=mel, **args
+            )
             writer(result, audio_path, **writer_args)
         except Exception as e:
             traceback.print_exc()
@@ -0,0 +1,99 @@
+import math
+from typing import List, Tuple
+
+import torch
+
+from .audio import FRAMES_PER_SECOND
+from .timing import median_filter
+
+
+def detect_speech(
+    mel: torch.Tensor,
+    *,
+    energy_threshold: float = 10.0,
+    max_energy_range: float = 30.0,
+    flatness_threshold: float = -3.0,
+    filter_width: int = 11,
+    min_speech_duration: float = 0.25,
+    min_silence_duration: float = 2.0,
+    speech_pad: float = 0.5,
+) -> List[Tuple[float, float]]:
+    """
+    Find the regions that likely contain speech from the frame energy and the spectral flatness
+    of a log-Mel spectrogram. This is a lightweight heuristic meant to skip long stretches of
+    silence or stationary noise, and errs on the side of keeping audio.
+
+    Parameters
+    ----------
+    mel: torch.Tensor, shape = (n_mels, n_frames)
+        The log-Mel spectrogram as returned by `log_mel_spectrogram`, without the padding
+
+    energy_threshold: float
+        A frame may be speech if its energy is this many dB above the noise floor, which is
+        estimated as the 10th percentile of the frame energies
+
+    max_energy_range: float
+        Frames within this many dB of the loudest one may always be speech, so that the noise floor
+        of a recording with little silence does not exclude its quieter speech
+
+    flatness_threshold: float
+        A frame may be speech only if its spectral flatness over the Mel bins is below this value in
+        dB; noise has a flat spectrum (0 dB), whereas speech concentrates on its formants
+
+    filter_width: int
+        The width of the median filter applied to the per-frame decisions, in frames
+
+    min_speech_duration: float
+        Speech regions shorter than this, in seconds, are dropped
+
+    min_silence_duration: float
+        Speech regions separated by a shorter silence than this, in seconds, are merged
+
+    speech_pad: float
+        The number of seconds to extend each speech region with on both sides
+
+    Returns
+    -------
+    A list of (start, end) timestamps in seconds of the speech regions, which can be given to
+    `transcribe` as `clip_timestamps`
+    """
+    n_frames = mel.shape[-1]
+    if n_frames == 0:
+        return []
+
+    # undo the normalization of `log_mel_spectrogram`, up to a constant offset
+    log_power = mel.float().cpu() * 4
+    energy = 10 * torch.logsumexp(log_power * math.log(10), dim=0) / math.log(10)
+    flatness = 10 * log_power.mean(dim=0) - energy + 10 * math.log10(mel.shape[0])
+
+    floor = torch.quantile(energy, 0.1)
+    threshold = min(floor + energy_threshold, energy.max() - max_energy_range)
+    is_speech = (energy > threshold) & (flatness < flatness_threshold)
+    is_speech = median_filter(is_speech.float(), filter_width) > 0.5
+
+    # find the boundaries of the runs of speech frames
+    changes = torch.diff(is_speech.int(), prepend=torch.zeros(1, dtype=torch.int))
+    starts = torch.nonzero(changes == 1).flatten().tolist()
+    ends = torch.nonzero(changes == -1).flatten().tolist()
+    if len(ends) < len(starts):
+        ends.append(n_frames)
+
+    regions: List[List[int]] = []
+    for start, end in zip(starts, ends):
+        if (
+            regions
+            and start - regions[-1][1] < min_silence_duration * FRAMES_PER_SECOND
+        ):
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+
+    pad = round(speech_pad * FRAMES_PER_SECOND)
+    return [
+        (
+            max(start - pad, 0) / FRAMES_PER_SECOND,
+            min(end + pad, n_frames) / FRAMES_PER_SECOND,
+        )
+        for start, end in regions
+        if end - start >= min_speech_duration * FRAMES_PER_SECOND
+    ]